@@ -1,26 +1,82 @@
-from .utils import Utils
+from .utils import Utils, NOT_COMPUTED
 from .resource_manager import ResourceManager
+from .sandbox import sandbox, SandboxError
+from .cache import TTLCache
 # import yaml
 import requests
 import pandas as pd
+import numpy as np
+import hashlib
+import json
+import os
+import textwrap
+import time
+from loguru import logger
+
+
+def _check_function(submission, solution, q_index, global_dict, tests=None, expected=None):
+    """
+    `Utils.check_function` as run in the sandbox. The FUNCTION answers of one
+    submission share `global_dict`, so an answer can use functions defined in
+    earlier ones; it is seeded with this module's globals on first use.
+    """
+    if not global_dict:
+        global_dict.update(globals())
+    return Utils.check_function(submission, solution, q_index, global_dict, tests, expected)
+
+
+def _check_expression(config, submission, solution, q_index, expected=NOT_COMPUTED,
+                      expected_fingerprint=None):
+    """`Utils.check_expression` as run in the sandbox, on the worker's copy of the dataframe"""
+    return Utils.check_expression(
+        submission, solution, q_index,
+        {**globals(), "df": ResourceManager.dataframe(config), "pd": pd},
+        expected, expected_fingerprint)
+
+
+def execute_dataframe_expression(config, expression: str, page_size: int = None):
+    """
+    `Utils.execute_expression` for /execute, to run in the sandbox on the
+    worker's copy of the dataframe in `config`. A result longer than
+    `page_size` comes back whole under "result" for the caller to store.
+    """
+    return Utils.execute_expression(
+        expression, {"df": ResourceManager.dataframe(config), "pd": pd, "np": np},
+        page_size=page_size, store=None)
 
 
 class Autograder:
-    def __init__(self, submission):
+    # Solution results shared by every submission of the same exam version
+    _expected_results = TTLCache(
+        "expected-results", ttl=float("inf"),
+        maxsize=int(os.getenv("EXPECTED_CACHE_SIZE", 256)))
+
+    def __init__(self, submission, solution=None, resource_manager=None, on_progress=None):
+        """
+        `solution` and `resource_manager` may be passed in to share them across
+        many submissions of the same exam; a shared resource manager is left open.
+        `on_progress` is called with an event dict when each question starts and
+        finishes grading.
+        """
+        self.on_progress = on_progress
         self.exam_id = submission.exam_id
         self.exam_name = submission.exam_name
         self.answers = [answer["answer"] for answer in submission.answers]
 
         # Load solutions and config
-        self.solution = ResourceManager._get_s3_data(
+        self.solution = solution or ResourceManager._get_s3_data(
             f"solutions/{self.exam_id}.yml")
         # with open(f"solutions/{self.exam_id}.yml") as f:
         #     self.solution = yaml.safe_load(f)
 
         # Initialize resource manager
-        self.resource_manager = ResourceManager(
+        self._owns_resources = resource_manager is None
+        self.resource_manager = resource_manager or ResourceManager(
             self.solution.get('config', {}))
 
+        # FUNCTION check results by question, filled on the first FUNCTION question
+        self._functions = None
+
         self.summary = {
             "Not submitted": [],
             "Incorrect": [],
@@ -30,51 +86,168 @@ class Autograder:
         }
 
     def grade_submission(self):
+        self.resource_manager.reset_databases()
         q_type_handlers = {
             "MULTICHOICE": lambda answer, i: (
                 Utils.check_multichoice(answer, self.solution[i]["answer"], i),
                 None,
             ),
-            "FUNCTION": lambda answer, i: Utils.check_function(
-                answer,
-                self.solution[i]["answer"],
+            "FUNCTION": lambda answer, i: self._function_results()[i],
+            "SQL": lambda answer, i: self._check_sql(answer, i),
+            "EXPRESSION": lambda answer, i: self._run_sandboxed(
                 i,
-                globals(),
-                self.resource_manager.get_resource('test_cases')[str(i)],
-            ),
-            "SQL": lambda answer, i: Utils.check_sql(
+                _check_expression,
+                self.solution.get('config', {}).get('resources', {}).get('dataframe'),
                 answer,
                 self.solution[i]["answer"],
                 i,
-                self.resource_manager.get_resource('database')
-            ),
-            "EXPRESSION": lambda answer, i:
-                Utils.check_expression(
-                    answer,
-                    self.solution[i]["answer"],
-                    i,
-                    {**globals(), "df": self.resource_manager.get_resource('dataframe'), "pd": pd},
+                self._expected(i),
+                self._fingerprint(i),
             ),
         }
 
-        for i, answer in enumerate(self.answers, 1):
-            issue = None
-            correct = None
-            if answer:
-                q_type = self.solution[i]["type"]
-                correct, issue = q_type_handlers[q_type](answer, i)
+        total = len(self.answers)
+        try:
+            for i, answer in enumerate(self.answers, 1):
+                issue = None
+                correct = None
+                started = time.perf_counter()
+                if answer:
+                    self._emit({"event": "question_started", "question": i, "total": total})
+                    q_type = self.solution[i]["type"]
+                    correct, issue = q_type_handlers[q_type](answer, i)
 
-            self.summary[
-                {
+                result = {
                     None: "Not submitted",
                     True: "Correct",
                     False: "Incorrect",
                     "Partial": "Partial",
                 }[correct]
-            ].append(i)
+                self.summary[result].append(i)
+
+                if issue:
+                    self.summary["Issue"].append((i, issue))
+
+                self._emit({
+                    "event": "question_finished",
+                    "question": i,
+                    "total": total,
+                    "result": result,
+                    "score": self.calculate_score(i) * {"Correct": 1, "Partial": 0.5}.get(result, 0),
+                    "max_score": self.calculate_score(i),
+                    "issue": issue,
+                    "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+                })
+        finally:
+            # Return leased database connections to the pool
+            if self._owns_resources:
+                self.resource_manager.close()
 
-            if issue:
-                self.summary["Issue"].append((i, issue))
+    def _emit(self, event: dict):
+        """Report grading progress; a failing listener never fails the grading"""
+        if self.on_progress is None:
+            return
+        try:
+            self.on_progress(event)
+        except Exception as e:
+            logger.warning(f"Grading progress listener failed: {e}")
+
+    def _compute_expected(self, q_index: int):
+        """Run the solution side of a question once"""
+        solution = self.solution[q_index]["answer"]
+        q_type = self.solution[q_index]["type"]
+        if q_type == "SQL":
+            return pd.read_sql_query(
+                solution, self.resource_manager.get_resource('database'))
+        if q_type == "EXPRESSION":
+            return eval(textwrap.dedent(solution), {
+                **globals(), "df": self.resource_manager.get_resource('dataframe'), "pd": pd})
+        if q_type == "FUNCTION":
+            return Utils.function_outputs(
+                solution, self.resource_manager.get_resource('test_cases')[str(q_index)])
+        raise ValueError(f"No precomputed result for {q_type} questions")
+
+    def _expected(self, q_index: int, default=NOT_COMPUTED):
+        """
+        Solution result for a question, memoized per exam, question and solution
+        version so grading only has to evaluate the student's side.
+        Falls back to `default` (evaluate in the check) if the solution fails.
+        """
+        try:
+            return self._expected_results.get(
+                self._cache_key(q_index),
+                lambda _: (self._compute_expected(q_index), None))
+        except Exception as e:
+            logger.warning(f"Could not precompute {self.exam_id} Q{q_index}: {e}")
+            return default
+
+    def _fingerprint(self, q_index: int, names: bool = True):
+        """Fingerprint of the memoized solution result, or None if there is none"""
+        expected = self._expected(q_index)
+        if expected is NOT_COMPUTED:
+            return None
+        return self._expected_results.get(
+            (*self._cache_key(q_index), "fingerprint", names),
+            lambda _: (Utils.fingerprint(expected, names=names), None))
+
+    def _cache_key(self, q_index: int) -> tuple:
+        version = hashlib.sha256(json.dumps(
+            [self.solution[q_index], self.solution.get('config', {})],
+            sort_keys=True, default=str).encode()).hexdigest()
+        return (self.exam_id, q_index, version)
+
+    @classmethod
+    def cache_stats(cls) -> dict:
+        return cls._expected_results.stats()
+
+    @staticmethod
+    def _run_sandboxed(q_index, fn, *args):
+        """Run a student-code check in the sandbox pool"""
+        try:
+            return sandbox.run(fn, *args)
+        except SandboxError as e:
+            return False, f"Q{q_index}: {e}"
+
+    def _check_sql(self, answer, i):
+        try:
+            return Utils.check_sql(
+                answer,
+                self.solution[i]["answer"],
+                i,
+                self.resource_manager.get_resource('database'),
+                self._expected(i),
+            )
+        finally:
+            # Answers may write to their copy of the database; later answers,
+            # solutions and submissions sharing the resource manager must not see it
+            self.resource_manager.reset_databases()
+
+    def _function_results(self) -> dict:
+        """
+        Check every FUNCTION answer of the submission, in question order, in
+        one sandbox call sharing one globals dict (see `_check_function`)
+        """
+        if self._functions is None:
+            questions = [i for i, answer in enumerate(self.answers, 1)
+                         if answer and self.solution[i]["type"] == "FUNCTION"]
+            global_dict = {}
+            calls = [(
+                self.answers[i - 1],
+                self.solution[i]["answer"],
+                i,
+                global_dict,
+                self.resource_manager.get_resource('test_cases')[str(i)],
+                self._expected(i, None),
+            ) for i in questions]
+            try:
+                results = sandbox.run_each(_check_function, calls)
+            except SandboxError as e:
+                results = [e] * len(questions)
+            self._functions = {
+                i: (False, f"Q{i}: {result}") if isinstance(result, Exception) else result
+                for i, result in zip(questions, results)
+            }
+        return self._functions
 
     def calculate_score(self, q_index: int) -> int:
         """Return the score for a question based on its type."""
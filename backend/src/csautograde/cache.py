@@ -0,0 +1,135 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Callable, Hashable, Optional
+
+from loguru import logger
+
+
+# Returned by a loader when the cached copy is still current (e.g. S3 replied 304)
+NOT_MODIFIED = object()
+
+
+@dataclass
+class CacheEntry:
+    value: Any
+    etag: Optional[str] = None
+    loaded_at: float = 0.0
+
+
+class TTLCache:
+    """
+    Thread-safe in-process cache shared by every request of the worker.
+
+    - Entries younger than `ttl` seconds are served straight from memory.
+    - Stale entries are revalidated by handing their ETag back to the loader,
+      which returns NOT_MODIFIED when the source has not changed.
+    - Concurrent misses for the same key share one in-flight load.
+    - At most `maxsize` entries are kept, least recently used evicted first.
+    """
+
+    def __init__(self, name: str, ttl: float = 300, maxsize: int = 128):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: OrderedDict[Hashable, CacheEntry] = OrderedDict()
+        self._inflight: dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "revalidated": 0,
+            "refreshed": 0,
+            "coalesced": 0,
+            "errors": 0,
+            "evictions": 0,
+        }
+
+    def get(self, key: Hashable, loader: Callable[[Optional[str]], Any]):
+        """
+        Return the cached value for `key`, loading it when needed.
+
+        `loader(etag)` must return either NOT_MODIFIED or a `(value, etag)` tuple.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry.loaded_at < self.ttl:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return entry.value
+
+            future = self._inflight.get(key)
+            if future is not None:
+                owner = False
+                self._stats["coalesced"] += 1
+            else:
+                owner = True
+                future = Future()
+                self._inflight[key] = future
+                self._stats["misses" if entry is None else "refreshed"] += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = self._load(key, entry, loader)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _load(self, key, entry: Optional[CacheEntry], loader):
+        try:
+            result = loader(entry.etag if entry else None)
+        except Exception as e:
+            with self._lock:
+                self._stats["errors"] += 1
+            if entry is None:
+                raise
+            # Keep serving the last good copy if the source is unreachable
+            logger.warning(f"[{self.name}] revalidation of {key} failed: {e}")
+            return entry.value
+
+        with self._lock:
+            if result is NOT_MODIFIED and entry is not None:
+                self._stats["revalidated"] += 1
+                entry.loaded_at = time.monotonic()
+                self._store(key, entry)
+                return entry.value
+
+            value, etag = result
+            self._store(key, CacheEntry(value, etag, time.monotonic()))
+            return value
+
+    def _store(self, key, entry: CacheEntry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def put(self, key: Hashable, value, etag: Optional[str] = None):
+        """Store a value loaded elsewhere, e.g. by a batched prefetch"""
+        with self._lock:
+            self._store(key, CacheEntry(value, etag, time.monotonic()))
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        """Drop one key, or every key when none is given."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "size": len(self._entries), "maxsize": self.maxsize,
+                    "ttl": None if math.isinf(self.ttl) else self.ttl}
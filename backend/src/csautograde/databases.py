@@ -0,0 +1,404 @@
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import requests
+from loguru import logger
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+@dataclass(frozen=True)
+class QueryBudget:
+    """Limits on one SQL statement; None disables a limit"""
+    name: str
+    seconds: float = None
+    # SQLite virtual machine instructions, independent of server load
+    instructions: int = None
+    max_rows: int = None
+
+
+class QueryAborted(sqlite3.OperationalError):
+    """A statement stopped because it went over its QueryBudget"""
+
+    MESSAGES = {
+        "time": "Query stopped: it ran for more than {budget.seconds:g}s (is a join condition missing?)",
+        "instructions": "Query stopped: it needed more than {budget.instructions:,} steps "
+                        "(is a join condition missing?)",
+        "rows": "Query stopped: it returned more than {budget.max_rows:,} rows",
+    }
+
+    def __init__(self, reason: str, budget: QueryBudget):
+        super().__init__(self.MESSAGES[reason].format(budget=budget))
+        self.reason = reason
+        self.budget = budget
+
+
+class GovernedCursor(sqlite3.Cursor):
+    """
+    Cursor that restarts its connection's budget on execute. `max_rows` only
+    caps `fetchall` (what pandas uses), where the whole result is held at
+    once; rows fetched a batch at a time to page or stream are not limited.
+    """
+
+    def execute(self, sql, parameters=()):
+        self.connection.start_statement()
+        try:
+            return super().execute(sql, parameters)
+        except sqlite3.OperationalError as e:
+            raise self.connection.aborted(e)
+
+    def fetchone(self):
+        try:
+            return super().fetchone()
+        except sqlite3.OperationalError as e:
+            raise self.connection.aborted(e)
+
+    def fetchmany(self, size=None):
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        except sqlite3.OperationalError as e:
+            raise self.connection.aborted(e)
+
+    def fetchall(self):
+        budget = self.connection.budget
+        max_rows = budget.max_rows if budget is not None else None
+        try:
+            # Never materialize more than one row past the cap
+            rows = super().fetchmany(max_rows + 1) if max_rows else super().fetchall()
+        except sqlite3.OperationalError as e:
+            raise self.connection.aborted(e)
+        if max_rows and len(rows) > max_rows:
+            raise self.connection.abort("rows")
+        return rows
+
+    def __next__(self):
+        try:
+            return super().__next__()
+        except sqlite3.OperationalError as e:
+            raise self.connection.aborted(e)
+
+
+class GovernedConnection(sqlite3.Connection):
+    """
+    SQLite connection that holds each statement to a QueryBudget.
+
+    A progress handler, called every PROGRESS_STEPS virtual machine
+    instructions, interrupts a statement that runs past the budget's time or
+    instruction count; fetching more than `max_rows` rows at once stops it too. The
+    interruption surfaces as a QueryAborted with a readable message.
+    """
+
+    PROGRESS_STEPS = 10000
+
+    budget: QueryBudget = None
+    on_abort = None
+    # State of a fresh copy, see SQLiteProvider._state
+    pristine: tuple = None
+
+    def cursor(self, factory=GovernedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        # sqlite3.Connection.execute bypasses the cursor's execute method
+        return self.cursor().execute(sql, parameters)
+
+    def govern(self, budget: QueryBudget = None):
+        self.budget = budget
+        if budget is not None and (budget.seconds or budget.instructions):
+            self.set_progress_handler(self._progress, self.PROGRESS_STEPS)
+        else:
+            self.set_progress_handler(None, 0)
+
+    def start_statement(self):
+        self._started = time.monotonic()
+        self._steps = 0
+        self._reason = None
+
+    def _progress(self) -> int:
+        budget = self.budget
+        if budget is None:
+            return 0
+        self._steps = getattr(self, "_steps", 0) + self.PROGRESS_STEPS
+        if budget.instructions and self._steps > budget.instructions:
+            self._reason = "instructions"
+            return 1
+        if budget.seconds and time.monotonic() - getattr(self, "_started", time.monotonic()) > budget.seconds:
+            self._reason = "time"
+            return 1
+        return 0
+
+    def abort(self, reason: str) -> QueryAborted:
+        if self.on_abort is not None:
+            self.on_abort(self.budget, reason)
+        return QueryAborted(reason, self.budget)
+
+    def aborted(self, error: sqlite3.OperationalError) -> sqlite3.OperationalError:
+        """The error to raise for `error`: a QueryAborted if the progress handler interrupted it"""
+        reason = getattr(self, "_reason", None)
+        if reason is None or isinstance(error, QueryAborted):
+            return error
+        self._reason = None
+        return self.abort(reason)
+
+
+# PRAGMAs that take an argument without changing the connection
+READ_ONLY_PRAGMAS = {
+    "table_info", "table_xinfo", "table_list", "index_list", "index_info", "index_xinfo",
+    "foreign_key_list", "foreign_key_check", "integrity_check", "quick_check",
+}
+
+
+def _authorize(action, arg1, arg2, database, source):
+    """Keep sessions self-contained: no attached files and no PRAGMA changes"""
+    if action in (sqlite3.SQLITE_ATTACH, sqlite3.SQLITE_DETACH):
+        return sqlite3.SQLITE_DENY
+    if (action == sqlite3.SQLITE_PRAGMA and arg2 is not None
+            and arg1.lower() not in READ_ONLY_PRAGMAS):
+        return sqlite3.SQLITE_DENY
+    return sqlite3.SQLITE_OK
+
+
+class SQLiteProvider:
+    """
+    Provisions the course SQLite databases and hands out pooled private copies of them.
+
+    Each database file is fetched at most once per process (usually it is already
+    bundled under `db/`), verified by SHA-256 and loaded once into an in-memory
+    master image. Every connection is an in-memory clone of that image, so
+    queries run from RAM and a session may even modify its copy: whatever a
+    student's DML or DDL changed, the connection is closed on release instead
+    of going back to the pool, and the next lease gets a fresh clone. A holder
+    that keeps one lease for many sessions calls `reset` between them instead.
+
+    Connections are GovernedConnections: each lease applies a QueryBudget
+    (GRADING for graded answers, PRACTICE for /execute), and aborted
+    statements are counted per budget and reason.
+    """
+
+    DATABASES = {
+        "northwind": {
+            "source": "https://github.com/nauqh/cseassessment/blob/master/backend/db/northwind.db?raw=true",
+            "sha256": "98a2b8bd66914504f9e77f54539cc999e73a476e6eefde111b163fed58f3bbeb",
+        },
+        "chinook": {
+            "source": "https://github.com/nauqh/cseassessment/blob/master/backend/db/chinook.db?raw=true",
+            "sha256": "bdf635be69850bd3be09c9a2dbeef7ddfb80036bd3ef3381383cd03b61e4a61a",
+        },
+    }
+
+    def __init__(self, directory: str = "db", pool_size: int = 8):
+        self.directory = directory
+        self.pool_size = pool_size
+        self._paths: dict[str, str] = {}
+        self._pools: dict[str, queue.LifoQueue] = {}
+        self._lock = threading.Lock()
+        self._provision_locks: dict[str, threading.Lock] = {}
+        self._aborted: dict[str, dict[str, int]] = {}
+        self._images: dict[str, bytes] = {}
+        self._clones = 0
+        self._discarded = 0
+        self._resets = 0
+
+    @staticmethod
+    def _sha256(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def path(self, name: str, source: str = None, sha256: str = None) -> str:
+        """Local path of a verified copy of database `name`, downloading it if needed"""
+        if name in self._paths:
+            return self._paths[name]
+
+        with self._lock:
+            lock = self._provision_locks.setdefault(name, threading.Lock())
+
+        with lock:
+            if name in self._paths:
+                return self._paths[name]
+
+            known = self.DATABASES.get(name, {})
+            source = source or known.get("source")
+            sha256 = sha256 or known.get("sha256")
+            path = os.path.join(self.directory, f"{name}.db")
+
+            if os.path.exists(path) and (not sha256 or self._sha256(path) == sha256):
+                logger.info(f"Using local database {path}")
+            else:
+                if not source:
+                    raise ValueError(f"Unknown database: {name}")
+                logger.info(f"Downloading database {name} from {source}")
+                response = requests.get(source, timeout=60)
+                response.raise_for_status()
+                content = response.content
+                checksum = hashlib.sha256(content).hexdigest()
+                if sha256 and checksum != sha256:
+                    raise ValueError(
+                        f"Checksum mismatch for database {name}: {checksum}")
+
+                # Write to a temporary file first so a half-written file is never opened
+                os.makedirs(self.directory, exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as file:
+                    file.write(content)
+                os.replace(tmp_path, path)
+
+            self._paths[name] = path
+            return path
+
+    def image(self, name: str) -> bytes:
+        """Serialized master image of database `name`, read from disk once"""
+        if name in self._images:
+            return self._images[name]
+
+        path = self.path(name)
+        with self._provision_locks[name]:
+            if name not in self._images:
+                source = sqlite3.connect(
+                    f"file:{os.path.abspath(path)}?mode=ro&immutable=1", uri=True)
+                try:
+                    self._images[name] = source.serialize()
+                finally:
+                    source.close()
+                logger.info(f"Loaded database {name} into memory ({len(self._images[name])} bytes)")
+        return self._images[name]
+
+    @staticmethod
+    def _state(connection: sqlite3.Connection) -> tuple:
+        """Changes made through a connection so far, to tell a clean copy from a modified one"""
+        return (
+            connection.total_changes,
+            connection.execute("PRAGMA main.schema_version").fetchone()[0],
+            connection.execute("PRAGMA temp.schema_version").fetchone()[0],
+        )
+
+    def reset(self, name: str, connection: sqlite3.Connection) -> bool:
+        """
+        Restore a leased copy that a session modified to the master image, in
+        place, so holders of the connection keep using it; True if it was modified
+        """
+        if connection.in_transaction:
+            connection.rollback()
+        if self._state(connection) == connection.pristine:
+            return False
+        budget = connection.budget
+        connection.govern(None)
+        try:
+            for kind in ("view", "trigger", "table"):
+                names = [row[0] for row in connection.execute(
+                    "SELECT name FROM temp.sqlite_master WHERE type = ?", (kind,)).fetchall()]
+                for object_name in names:
+                    quoted = object_name.replace('"', '""')
+                    connection.execute(f'DROP {kind} IF EXISTS temp."{quoted}"')
+            # The authorizer would refuse deserialize like an ATTACH
+            connection.set_authorizer(None)
+            connection.deserialize(self.image(name))
+            connection.pristine = self._state(connection)
+        finally:
+            connection.set_authorizer(_authorize)
+            connection.govern(budget)
+        with self._lock:
+            self._resets += 1
+        return True
+
+    def _open(self, name: str) -> GovernedConnection:
+        """A private in-memory copy of the master image"""
+        image = self.image(name)
+        connection = sqlite3.connect(
+            ":memory:", check_same_thread=False, factory=GovernedConnection)
+        # deserialize copies the image, so the master is never written
+        connection.deserialize(image)
+        connection.set_authorizer(_authorize)
+        connection.on_abort = self._record_abort
+        connection.pristine = self._state(connection)
+        with self._lock:
+            self._clones += 1
+        return connection
+
+    def _record_abort(self, budget: QueryBudget, reason: str):
+        logger.info(f"Aborted {budget.name} query: {reason} budget exceeded")
+        with self._lock:
+            counts = self._aborted.setdefault(budget.name, {"time": 0, "instructions": 0, "rows": 0})
+            counts[reason] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "aborted": {name: dict(counts) for name, counts in self._aborted.items()},
+                "pooled": {name: pool.qsize() for name, pool in self._pools.items()},
+                "images": {name: len(image) for name, image in self._images.items()},
+                "clones": self._clones,
+                "discarded": self._discarded,
+                "resets": self._resets,
+            }
+
+    def _pool(self, name: str) -> queue.LifoQueue:
+        with self._lock:
+            return self._pools.setdefault(name, queue.LifoQueue(maxsize=self.pool_size))
+
+    def acquire(self, name: str, source: str = None, sha256: str = None,
+                budget: QueryBudget = None) -> GovernedConnection:
+        """Take a connection from the pool (opening a new one when it is empty), governed by `budget`"""
+        self.path(name, source, sha256)
+        try:
+            connection = self._pool(name).get_nowait()
+        except queue.Empty:
+            connection = self._open(name)
+        connection.govern(budget)
+        return connection
+
+    def release(self, name: str, connection: sqlite3.Connection):
+        """
+        Return a connection to the pool; it is closed instead if its copy was
+        modified or the pool is already full
+        """
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+            connection.govern(None)
+            if self._state(connection) != connection.pristine:
+                with self._lock:
+                    self._discarded += 1
+                connection.close()
+                return
+            self._pool(name).put_nowait(connection)
+        except (queue.Full, sqlite3.Error):
+            connection.close()
+
+    @contextmanager
+    def connection(self, name: str, budget: QueryBudget = None):
+        conn = self.acquire(name, budget=budget)
+        try:
+            yield conn
+        finally:
+            self.release(name, conn)
+
+
+# Graded answers get more room than practice runs in /execute; 0 disables a limit
+GRADING = QueryBudget(
+    "grading",
+    seconds=float(os.getenv("SQL_GRADING_SECONDS", 10)) or None,
+    instructions=int(os.getenv("SQL_GRADING_INSTRUCTIONS", 1_000_000_000)) or None,
+    max_rows=int(os.getenv("SQL_GRADING_MAX_ROWS", 100_000)) or None,
+)
+PRACTICE = QueryBudget(
+    "practice",
+    seconds=float(os.getenv("SQL_PRACTICE_SECONDS", 5)) or None,
+    instructions=int(os.getenv("SQL_PRACTICE_INSTRUCTIONS", 500_000_000)) or None,
+    max_rows=int(os.getenv("SQL_PRACTICE_MAX_ROWS", 100_000)) or None,
+)
+
+databases = SQLiteProvider(
+    directory=os.getenv("SQLITE_DB_DIR", "db"),
+    pool_size=int(os.getenv("SQLITE_POOL_SIZE", 8)),
+)
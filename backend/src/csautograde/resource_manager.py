@@ -1,21 +1,34 @@
 import pandas as pd
-import sqlite3
 import psycopg
-import requests
-import boto3
 import yaml
 import json
+import os
 from loguru import logger
 
+from .cache import TTLCache, NOT_MODIFIED
+from .databases import databases, GRADING
+from .s3 import s3
+
 from dotenv import load_dotenv
 
 load_dotenv()
 
 
 class ResourceManager:
+    # Parsed solution/test-case files, revalidated against S3 by ETag once the TTL expires
+    _s3_cache = TTLCache(
+        "s3-data",
+        ttl=float(os.getenv("SOLUTION_CACHE_TTL", 300)),
+        maxsize=int(os.getenv("SOLUTION_CACHE_SIZE", 64)),
+    )
+    # Preprocessed dataframes keyed by their config, kept resident for every request
+    _dataframes = TTLCache("dataframes", ttl=float("inf"), maxsize=4)
+    BUCKET = "cseassessment"
+
     def __init__(self, config):
         self.config = config
         self.resources = {}
+        self._leases = []
         self._initialize_resources()
 
     def _initialize_resources(self):
@@ -44,12 +57,12 @@ class ResourceManager:
             raise ValueError(f"Unsupported database type: {db_type}")
 
     def _init_sqlite_db(self, config):
-        """Initialize SQLite database"""
-        if 'source' in config:
-            response = requests.get(config['source'])
-            with open(config['filename'], "wb") as file:
-                file.write(response.content)
-        return sqlite3.connect(config['filename'])
+        """Lease a read-only connection to a locally cached SQLite database"""
+        name = os.path.splitext(os.path.basename(config['filename']))[0]
+        connection = databases.acquire(
+            name, config.get('source'), config.get('sha256'), budget=GRADING)
+        self._leases.append((name, connection))
+        return connection
 
     def _init_postgres_db(self, config):
         """Initialize PostgreSQL database"""
@@ -57,7 +70,24 @@ class ResourceManager:
         return psycopg.connect(**conn_params)
 
     def _init_dataframe(self, config):
-        """Initialize and preprocess dataframe"""
+        return self._shared_dataframe(config)
+
+    @classmethod
+    def _shared_dataframe(cls, config):
+        """Return the shared preprocessed dataframe, building it once per config version"""
+        version = json.dumps(config, sort_keys=True, default=str)
+        return cls._dataframes.get(
+            version, lambda _: (cls._load_dataframe(config), None))
+
+    @classmethod
+    def dataframe(cls, config):
+        """A private copy of the dataframe for `config`, without a ResourceManager"""
+        return cls._private_copy(cls._shared_dataframe(config))
+
+    @staticmethod
+    def _load_dataframe(config):
+        """Load and preprocess dataframe"""
+        logger.info(f"Loading dataframe: {config['source']}")
         df = pd.read_csv(config['source'])
 
         for step in config.get('preprocess', []):
@@ -69,29 +99,84 @@ class ResourceManager:
 
         return df
 
+    @staticmethod
+    def _private_copy(df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Copy of the shared dataframe that a caller may mutate freely.
+        Under copy-on-write a shallow copy is enough; otherwise copy the data.
+        """
+        copy_on_write = (
+            int(pd.__version__.split(".")[0]) >= 3
+            or pd.options.mode.copy_on_write is True
+        )
+        return df.copy(deep=not copy_on_write)
+
     def _init_test_cases(self, config):
         """Initialize test cases"""
         return self._get_s3_data(config['source'])
 
+    @staticmethod
+    def _parse(key: str, data: bytes):
+        data = data.decode("utf-8")
+        if key.endswith(".yml") or key.endswith(".yaml"):
+            return yaml.safe_load(data)
+        elif key.endswith(".json"):
+            return json.loads(data)
+        raise ValueError(f"Unsupported file format for key: {key}")
+
     @classmethod
-    def _get_s3_data(cls, key: str) -> dict:
+    def _fetch_s3_object(cls, key: str, etag: str | None = None):
+        """Download and parse an S3 object, or return NOT_MODIFIED if `etag` still matches"""
         logger.info(f"Fetching data from S3: {key}")
-        """Fetches data from the specified S3 key"""
-        s3 = boto3.client("s3", region_name="ap-southeast-1")
+        obj = s3.get(cls.BUCKET, key, etag)
+        if obj is NOT_MODIFIED:
+            return NOT_MODIFIED
+        return cls._parse(key, obj.body), obj.etag
+
+    @classmethod
+    def prefetch(cls, keys: list[str]):
+        """Load several solution/test-case files concurrently into the cache"""
+        for key, obj in s3.get_many(cls.BUCKET, keys).items():
+            if isinstance(obj, Exception):
+                logger.warning(f"Could not prefetch {key}: {obj}")
+                continue
+            try:
+                cls._s3_cache.put(key, cls._parse(key, obj.body), obj.etag)
+            except Exception as e:
+                logger.warning(f"Could not parse {key}: {e}")
+
+    @classmethod
+    def _get_s3_data(cls, key: str) -> dict:
+        """
+        Fetches data from the specified S3 key.
+        The parsed object is shared process-wide, so callers must treat it as read-only.
+        """
         try:
-            obj = s3.get_object(Bucket="cseassessment", Key=key)
-            data = obj["Body"].read().decode("utf-8")
-            if key.endswith(".yml") or key.endswith(".yaml"):
-                return yaml.safe_load(data)
-            elif key.endswith(".json"):
-                return json.loads(data)
-            else:
-                print(f"Unsupported file format for key: {key}")
-                return None
+            return cls._s3_cache.get(
+                key, lambda etag: cls._fetch_s3_object(key, etag))
         except Exception as e:
             print("An unexpected error occurred:", e)
             return None
 
+    @classmethod
+    def cache_stats(cls) -> dict:
+        return {"s3": cls._s3_cache.stats(), "dataframes": cls._dataframes.stats()}
+
+    def reset_databases(self):
+        """Undo whatever answers changed in the leased databases"""
+        for name, connection in self._leases:
+            if databases.reset(name, connection):
+                logger.info(f"Reset database {name} after it was modified")
+
+    def close(self):
+        """Return pooled connections leased by this manager"""
+        while self._leases:
+            databases.release(*self._leases.pop())
+
     def get_resource(self, resource_type):
         """Get a specific resource"""
-        return self.resources.get(resource_type)
+        resource = self.resources.get(resource_type)
+        if resource_type == 'dataframe' and resource is not None:
+            # Never hand out the shared frame itself
+            return self._private_copy(resource)
+        return resource
@@ -0,0 +1,131 @@
+import math
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Hashable, Optional
+
+import pandas as pd
+
+
+@dataclass
+class StoredResult:
+    value: Any
+    stored_at: float
+    # Row order for each (column, ascending) the result has been sorted by
+    orders: dict = field(default_factory=dict)
+
+
+class ResultStore:
+    """
+    Keeps large pandas results in memory so they can be paged without
+    re-running the expression that produced them.
+
+    Results are grouped per user: each user keeps at most `per_user` results
+    (least recently used dropped first), at most `max_users` users are tracked,
+    and a result expires `ttl` seconds after it was stored.
+    """
+
+    def __init__(self, ttl: float = 600, per_user: int = 4, max_users: int = 1000):
+        self.ttl = ttl
+        self.per_user = per_user
+        self.max_users = max_users
+        self._users: OrderedDict[Hashable, OrderedDict[str, StoredResult]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"stored": 0, "hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+
+    def put(self, user: Optional[str], value) -> str:
+        """Store a result for `user` and return its handle"""
+        handle = uuid.uuid4().hex
+        now = time.monotonic()
+        with self._lock:
+            results = self._users.setdefault(user, OrderedDict())
+            self._users.move_to_end(user)
+            results[handle] = StoredResult(value, now)
+            self._stats["stored"] += 1
+
+            while len(results) > self.per_user:
+                results.popitem(last=False)
+                self._stats["evictions"] += 1
+            while len(self._users) > self.max_users:
+                _, dropped = self._users.popitem(last=False)
+                self._stats["evictions"] += len(dropped)
+        return handle
+
+    def get(self, user: Optional[str], handle: str) -> Optional[StoredResult]:
+        """The stored result, or None if it does not exist, expired or belongs to another user"""
+        with self._lock:
+            results = self._users.get(user)
+            entry = results.get(handle) if results else None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            if time.monotonic() - entry.stored_at >= self.ttl:
+                del results[handle]
+                self._stats["expired"] += 1
+                return None
+            results.move_to_end(handle)
+            self._users.move_to_end(user)
+            self._stats["hits"] += 1
+            return entry
+
+    @staticmethod
+    def _column(frame: pd.DataFrame, name):
+        """Column label for `name`, also accepting the "a_b" form of MultiIndex labels"""
+        if name in frame.columns:
+            return name
+        for label in frame.columns:
+            if isinstance(label, tuple) and "_".join(str(part) for part in label) == name:
+                return label
+            if str(label) == name:
+                return label
+        raise ValueError(f"Unknown column {name!r}")
+
+    @classmethod
+    def page(cls, entry: StoredResult, offset: int = 0, limit: int = 1000,
+             sort_by: Optional[Hashable] = None, ascending: bool = True,
+             columns: Optional[list] = None):
+        """
+        A slice of a stored DataFrame or Series, optionally sorted by one
+        column (any `sort_by` sorts a Series by its values) and restricted
+        to some columns. The sort order is computed once per column and direction.
+        """
+        value = entry.value
+        if columns is not None:
+            if not isinstance(value, pd.DataFrame):
+                raise ValueError("Only DataFrame results have columns")
+            value = value.loc[:, [cls._column(value, name) for name in columns]]
+
+        if sort_by is not None:
+            key = (sort_by, ascending)
+            if key not in entry.orders:
+                if isinstance(entry.value, pd.Series):
+                    values = entry.value
+                else:
+                    values = entry.value.loc[:, cls._column(entry.value, sort_by)]
+                    if isinstance(values, pd.DataFrame):
+                        raise ValueError(f"Column {sort_by!r} is not unique")
+                entry.orders[key] = values.reset_index(drop=True).sort_values(
+                    ascending=ascending, kind="stable", na_position="last").index.to_numpy()
+            positions = entry.orders[key][offset:offset + limit]
+            return value.iloc[positions]
+
+        return value.iloc[offset:offset + limit]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._stats,
+                "users": len(self._users),
+                "results": sum(len(results) for results in self._users.values()),
+                "ttl": None if math.isinf(self.ttl) else self.ttl,
+            }
+
+
+results = ResultStore(
+    ttl=float(os.getenv("RESULT_STORE_TTL", 600)),
+    per_user=int(os.getenv("RESULT_STORE_PER_USER", 4)),
+    max_users=int(os.getenv("RESULT_STORE_USERS", 1000)),
+)
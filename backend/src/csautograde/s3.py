@@ -0,0 +1,135 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from .cache import NOT_MODIFIED
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class S3NotFound(Exception):
+    """Raised when the requested key does not exist"""
+
+
+@dataclass
+class S3Object:
+    body: bytes
+    etag: str | None = None
+
+
+class S3Client:
+    """
+    One long-lived S3 client shared by the whole process.
+
+    The underlying boto3 client (and its connection pool) is created once and is
+    safe to use from many threads; `get_many` fetches several keys concurrently
+    on a small thread pool. Every call is timed per operation.
+
+    Point `endpoint_url` at a local stand-in (moto server, MinIO) for testing,
+    or pass a ready-made `client`.
+    """
+
+    def __init__(self, region_name: str = None, endpoint_url: str = None,
+                 max_connections: int = 20, client=None):
+        self.region_name = region_name
+        self.endpoint_url = endpoint_url
+        self.max_connections = max_connections
+        self._client = client
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_connections, thread_name_prefix="s3")
+        self._stats: dict[str, dict] = {}
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = boto3.client(
+                    "s3",
+                    region_name=self.region_name,
+                    endpoint_url=self.endpoint_url,
+                    config=Config(
+                        max_pool_connections=self.max_connections,
+                        retries={"max_attempts": 3, "mode": "standard"},
+                        tcp_keepalive=True,
+                    ),
+                )
+            return self._client
+
+    def _record(self, operation: str, started: float, error: bool = False):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            stats = self._stats.setdefault(
+                operation, {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stats["calls"] += 1
+            stats["errors"] += error
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+
+    def get(self, bucket: str, key: str, etag: str = None):
+        """
+        Download an object. With `etag`, returns NOT_MODIFIED if it still matches.
+        Raises S3NotFound for a missing key.
+        """
+        params = {"Bucket": bucket, "Key": key}
+        if etag:
+            params["IfNoneMatch"] = etag
+
+        started = time.perf_counter()
+        try:
+            obj = self.client.get_object(**params)
+            body = obj["Body"].read()
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code in ("304", "NotModified"):
+                self._record("get_object", started)
+                return NOT_MODIFIED
+            self._record("get_object", started, error=True)
+            if code in ("404", "NoSuchKey"):
+                raise S3NotFound(f"s3://{bucket}/{key}")
+            raise
+        except Exception:
+            self._record("get_object", started, error=True)
+            raise
+
+        self._record("get_object", started)
+        return S3Object(body, obj.get("ETag"))
+
+    def get_many(self, bucket: str, keys: list[str]) -> dict:
+        """Fetch several keys concurrently; failed keys map to their exception"""
+        futures = {key: self._executor.submit(self.get, bucket, key) for key in keys}
+        results = {}
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                results[key] = e
+        return results
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                operation: {
+                    **stats,
+                    "avg_ms": stats["total_ms"] / stats["calls"] if stats["calls"] else 0.0,
+                }
+                for operation, stats in self._stats.items()
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+s3 = S3Client(
+    region_name=os.getenv("AWS_REGION", "ap-southeast-1"),
+    endpoint_url=os.getenv("S3_ENDPOINT_URL") or None,
+    max_connections=int(os.getenv("S3_MAX_CONNECTIONS", 20)),
+)
@@ -0,0 +1,411 @@
+import asyncio
+import math
+import multiprocessing
+import os
+import resource
+import signal
+import threading
+import time
+import weakref
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+
+from loguru import logger
+
+
+class SandboxError(Exception):
+    """Raised when a sandbox run is killed or its worker dies before returning a result"""
+
+
+@dataclass(frozen=True)
+class Budget:
+    """Resources one sandbox run may use; None disables a limit"""
+    cpu_seconds: float = None
+    memory_mb: int = None
+    wall_seconds: float = None
+
+
+class BudgetExceeded(BaseException):
+    """
+    Raised inside a run that went over its budget. Not an Exception, so the
+    `except Exception` around student code (theirs or ours) does not swallow it.
+    """
+
+    MESSAGES = {
+        "cpu": "Execution exceeded its CPU time budget of {limit:g}s",
+        "wall": "Execution exceeded its time limit of {limit:g}s",
+        "memory": "Execution exceeded its memory budget of {limit:g} MB",
+    }
+
+    def __init__(self, kind: str, limit, usage: dict = None):
+        super().__init__(kind, limit, usage)
+        self.kind = kind
+        self.limit = limit
+        self.usage = usage
+
+    def __str__(self):
+        return self.MESSAGES[self.kind].format(limit=self.limit)
+
+
+def _vm_size() -> int:
+    """Address space of this process in bytes, or None where /proc is not available"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmSize:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class _Limits:
+    """
+    Applies a budget to the current process for the duration of one run.
+
+    CPU and wall time are enforced by interval timers whose signal handlers
+    raise BudgetExceeded (repeating, in case student code catches it). As a
+    backstop for code stuck in C, RLIMIT_CPU is set at twice the CPU budget:
+    the kernel then terminates the worker. Memory is capped with RLIMIT_AS
+    at the current address space plus the budget. Signals can only be
+    handled in the main thread; elsewhere only the rlimits apply.
+    """
+
+    REPEAT = 0.5
+
+    def __init__(self, budget: Budget):
+        self.budget = budget
+        self._handlers = {}
+        self._rlimits = {}
+        self.memory_limited = False
+
+    @staticmethod
+    def _raiser(kind: str, limit):
+        def handler(signum, frame):
+            raise BudgetExceeded(kind, limit)
+        return handler
+
+    def _set_rlimit(self, which, soft: int):
+        current_soft, hard = resource.getrlimit(which)
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+        self._rlimits[which] = (current_soft, hard)
+        resource.setrlimit(which, (soft, hard))
+
+    def __enter__(self):
+        budget = self.budget
+        in_main_thread = threading.current_thread() is threading.main_thread()
+        if budget.cpu_seconds:
+            self._set_rlimit(resource.RLIMIT_CPU,
+                             math.ceil(_cpu_time() + 2 * budget.cpu_seconds + 1))
+            if in_main_thread:
+                self._handlers[signal.SIGPROF] = signal.signal(
+                    signal.SIGPROF, self._raiser("cpu", budget.cpu_seconds))
+                signal.setitimer(signal.ITIMER_PROF, budget.cpu_seconds, self.REPEAT)
+        if budget.wall_seconds and in_main_thread:
+            self._handlers[signal.SIGALRM] = signal.signal(
+                signal.SIGALRM, self._raiser("wall", budget.wall_seconds))
+            signal.setitimer(signal.ITIMER_REAL, budget.wall_seconds, self.REPEAT)
+        if budget.memory_mb:
+            vm_size = _vm_size()
+            if vm_size is not None:
+                self._set_rlimit(resource.RLIMIT_AS, vm_size + budget.memory_mb * 1024 * 1024)
+                self.memory_limited = True
+        return self
+
+    def __exit__(self, *exc):
+        if signal.SIGPROF in self._handlers:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+        if signal.SIGALRM in self._handlers:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        for signum, handler in self._handlers.items():
+            signal.signal(signum, handler)
+        for which, limits in self._rlimits.items():
+            resource.setrlimit(which, limits)
+        return False
+
+
+def _run_budgeted(fn, args, budget: Budget):
+    """Run `fn(*args)` under `budget`; returns (result, usage)"""
+    cpu_started = _cpu_time()
+    started = time.perf_counter()
+
+    def usage():
+        return {
+            "cpu_ms": round((_cpu_time() - cpu_started) * 1000, 1),
+            "wall_ms": round((time.perf_counter() - started) * 1000, 1),
+            # High-water mark of the worker process (kB on Linux)
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+
+    limits = _Limits(budget)
+    try:
+        with limits:
+            result = fn(*args)
+    except BudgetExceeded as e:
+        raise BudgetExceeded(e.kind, e.limit, usage())
+    except MemoryError:
+        if not limits.memory_limited:
+            raise
+        raise BudgetExceeded("memory", budget.memory_mb, usage())
+    return result, usage()
+
+
+def _run_each(fn, calls: list, budget: Budget) -> list:
+    """
+    Run `fn(*args)` for each args in `calls`, in order and each under its own
+    budget; returns (True, (result, usage)) or (False, exception) per call
+    """
+    outcomes = []
+    for args in calls:
+        try:
+            outcomes.append((True, _run_budgeted(fn, args, budget)))
+        except (Exception, BudgetExceeded) as e:
+            outcomes.append((False, e))
+    return outcomes
+
+
+class SandboxPool:
+    """
+    Pool of worker processes that run student code away from the API process.
+
+    Workers are forked from a forkserver that has pandas, numpy and the grading
+    utilities already imported, so a run pays no import cost. Every worker has
+    its own stdout, serves `max_runs` executions and is then replaced. With
+    `workers=0` everything runs inline, which is what the CLI and the re-grade
+    workers (already separate processes) use.
+
+    Every run is held to `budget` (see `_Limits`): a run over its CPU, memory
+    or wall-clock budget is stopped inside its worker and reported as a
+    SandboxError, leaving the worker to serve the next run. A run that still
+    has not returned `KILL_GRACE` seconds after its wall-clock budget is
+    killed with the rest of the pool, which is then restarted; the other runs
+    lost with it are retried once on the new pool. `run_each` runs several
+    calls in one worker, each with its own budget.
+    """
+
+    PRELOAD = ["pandas", "numpy", f"{__package__}.utils", f"{__package__}.autograder"]
+    KILL_GRACE = 5
+
+    def __init__(self, workers: int = None, max_runs: int = 50, budget: Budget = Budget()):
+        self.workers = os.cpu_count() if workers is None else workers
+        self.max_runs = max_runs
+        self.budget = budget
+        self._executor = None
+        # Pools killed for a run over its wall-clock budget
+        self._killed = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._stats = {"runs": 0, "over_cpu": 0, "over_wall": 0, "over_memory": 0, "killed": 0,
+                       "total_cpu_ms": 0.0, "max_cpu_ms": 0.0,
+                       "total_wall_ms": 0.0, "max_wall_ms": 0.0, "max_rss_mb": 0.0}
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                ctx = multiprocessing.get_context("forkserver")
+                ctx.set_forkserver_preload(self.PRELOAD)
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=ctx,
+                    max_tasks_per_child=self.max_runs,
+                )
+                logger.info(f"Started sandbox pool with {self.workers} workers")
+            return self._executor
+
+    def _discard(self, executor: ProcessPoolExecutor):
+        """Drop a broken executor so the next run starts a fresh one"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _kill(self, executor: ProcessPoolExecutor):
+        """Kill every worker of a pool with a run that ignores its budget"""
+        # The executor fails every pending run once any of its workers dies, so
+        # killing only the overdue one would not spare the rest; see `_innocent`
+        self._killed.add(executor)
+        for process in list(getattr(executor, "_processes", {}).values()):
+            process.kill()
+        self._discard(executor)
+
+    def submit(self, fn, *args) -> Future:
+        """Schedule `fn(*args)`; the future resolves to (result, usage)"""
+        return self._submit(fn, args)[0]
+
+    def _submit(self, fn, args, runner=_run_budgeted) -> tuple[Future, ProcessPoolExecutor]:
+        if not self.workers:
+            future = Future()
+            try:
+                future.set_result(runner(fn, args, self.budget))
+            except (Exception, BudgetExceeded) as e:
+                future.set_exception(e)
+            return future, None
+
+        executor = self._get_executor()
+        try:
+            future = executor.submit(runner, fn, args, self.budget)
+        except BrokenProcessPool:
+            self._discard(executor)
+            executor = self._get_executor()
+            future = executor.submit(runner, fn, args, self.budget)
+        future.add_done_callback(lambda f: self._check_broken(f, executor))
+        return future, executor
+
+    def _check_broken(self, future: Future, executor: ProcessPoolExecutor):
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            logger.warning("Sandbox worker died, restarting the pool")
+            self._discard(executor)
+
+    def _record(self, usage: dict, over: str = None):
+        with self._lock:
+            stats = self._stats
+            stats["runs"] += 1
+            if over:
+                stats[f"over_{over}"] += 1
+            if usage:
+                stats["total_cpu_ms"] += usage["cpu_ms"]
+                stats["max_cpu_ms"] = max(stats["max_cpu_ms"], usage["cpu_ms"])
+                stats["total_wall_ms"] += usage["wall_ms"]
+                stats["max_wall_ms"] = max(stats["max_wall_ms"], usage["wall_ms"])
+                stats["max_rss_mb"] = max(stats["max_rss_mb"], usage["max_rss_mb"])
+
+    def _unwrap(self, future: Future, fn):
+        try:
+            outcome = future.result()
+        except BrokenProcessPool:
+            raise self._lost()
+        except BudgetExceeded as e:
+            raise self._over_budget(e, fn)
+        result, usage = outcome
+        self._record(usage)
+        logger.debug(f"Sandbox run of {fn.__name__}: {usage}")
+        return result
+
+    def _lost(self) -> SandboxError:
+        with self._lock:
+            self._stats["runs"] += 1
+            self._stats["killed"] += 1
+        return SandboxError(
+            "Execution was terminated unexpectedly (it may have exceeded its CPU or memory budget)")
+
+    def _over_budget(self, e: BudgetExceeded, fn) -> SandboxError:
+        self._record(e.usage, e.kind)
+        logger.warning(f"Sandbox run of {fn.__name__} stopped: {e} (usage {e.usage})")
+        return SandboxError(str(e))
+
+    def _deadline(self, runs: int = 1):
+        if not self.budget.wall_seconds:
+            return None
+        return self.budget.wall_seconds * runs + self.KILL_GRACE
+
+    def _timed_out(self, executor: ProcessPoolExecutor):
+        with self._lock:
+            self._stats["runs"] += 1
+            self._stats["over_wall"] += 1
+            self._stats["killed"] += 1
+        logger.warning("Sandbox run ignored its time limit; killing the pool")
+        if executor is not None:
+            self._kill(executor)
+        return SandboxError(str(BudgetExceeded("wall", self.budget.wall_seconds)))
+
+    def _innocent(self, future: Future, executor: ProcessPoolExecutor) -> bool:
+        """Whether a finished run was only lost because its pool was killed for another run"""
+        return (executor is not None and executor in self._killed
+                and isinstance(future.exception(), BrokenProcessPool))
+
+    def _wait(self, future: Future, executor: ProcessPoolExecutor, runs: int = 1):
+        try:
+            future.result(timeout=self._deadline(runs))
+        except FutureTimeout:
+            raise self._timed_out(executor)
+        except (Exception, BudgetExceeded):
+            pass
+
+    async def _await(self, future: Future, executor: ProcessPoolExecutor):
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self._deadline())
+        except TimeoutError:
+            raise self._timed_out(executor)
+        except (Exception, BudgetExceeded):
+            pass
+
+    def run(self, fn, *args):
+        """Run `fn(*args)` in a worker and wait for its result"""
+        future, executor = self._submit(fn, args)
+        self._wait(future, executor)
+        if self._innocent(future, executor):
+            future, executor = self._submit(fn, args)
+            self._wait(future, executor)
+        return self._unwrap(future, fn)
+
+    def run_each(self, fn, calls: list[tuple]) -> list:
+        """
+        Run `fn(*args)` for each args in `calls`, in order, in one worker, so
+        the calls can share state through their arguments (one dict passed to
+        each, say). Every call gets its own budget. Returns one entry per call:
+        its result, or the exception it raised (a SandboxError when it went over
+        its budget). Raises SandboxError if the worker itself is lost.
+        """
+        future, executor = self._submit(fn, calls, runner=_run_each)
+        self._wait(future, executor, len(calls))
+        if self._innocent(future, executor):
+            future, executor = self._submit(fn, calls, runner=_run_each)
+            self._wait(future, executor, len(calls))
+        try:
+            outcomes = future.result()
+        except BrokenProcessPool:
+            raise self._lost()
+        results = []
+        for ok, outcome in outcomes:
+            if ok:
+                result, usage = outcome
+                self._record(usage)
+                results.append(result)
+            elif isinstance(outcome, BudgetExceeded):
+                results.append(self._over_budget(outcome, fn))
+            else:
+                results.append(outcome)
+        return results
+
+    async def arun(self, fn, *args):
+        """Run `fn(*args)` in a worker without blocking the event loop"""
+        future, executor = self._submit(fn, args)
+        await self._await(future, executor)
+        if self._innocent(future, executor):
+            future, executor = self._submit(fn, args)
+            await self._await(future, executor)
+        return self._unwrap(future, fn)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["avg_cpu_ms"] = stats["total_cpu_ms"] / stats["runs"] if stats["runs"] else 0.0
+        stats["budget"] = {
+            "cpu_seconds": self.budget.cpu_seconds,
+            "memory_mb": self.budget.memory_mb,
+            "wall_seconds": self.budget.wall_seconds,
+        }
+        return stats
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+sandbox = SandboxPool(
+    workers=int(os.getenv("SANDBOX_WORKERS", os.cpu_count() or 1)),
+    max_runs=int(os.getenv("SANDBOX_MAX_RUNS", 50)),
+    budget=Budget(
+        cpu_seconds=float(os.getenv("SANDBOX_CPU_SECONDS", 10)) or None,
+        memory_mb=int(os.getenv("SANDBOX_MEMORY_MB", 1024)) or None,
+        wall_seconds=float(os.getenv("SANDBOX_WALL_SECONDS", 20)) or None,
+    ),
+)
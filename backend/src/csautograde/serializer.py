@@ -0,0 +1,219 @@
+"""
+JSON serialization of pandas results for /execute.
+
+Values are converted a whole column at a time: numeric columns go through
+`tolist()` (NaN and inf are written as null by the encoder), missing values
+become None, and timestamps, periods, intervals and other non-JSON values
+become strings.
+"""
+import datetime
+import math
+
+import numpy as np
+import orjson
+import pandas as pd
+
+
+def _default(obj):
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return bytes(obj).decode("utf-8", errors="replace")
+    return serialize_value(obj)
+
+
+def dumps(obj, option: int = 0) -> bytes:
+    """Encode to JSON bytes; NaN and inf become null"""
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS | option)
+
+
+def serialize_value(val):
+    """Convert a single value to a JSON-compatible Python value"""
+    if isinstance(val, (np.integer, np.int64)):
+        return int(val)
+    elif isinstance(val, (np.floating, np.float64)):
+        # Handle infinity and NaN values properly
+        if np.isnan(val) or np.isinf(val):
+            return None
+        return float(val)
+    elif isinstance(val, (np.bool_)):
+        return bool(val)
+    elif isinstance(val, np.ndarray):
+        return [serialize_value(x) for x in val.tolist()]
+    elif isinstance(val, (tuple, list)):
+        return [serialize_value(x) for x in val]
+    elif isinstance(val, dict):
+        return {str(k): serialize_value(v) for k, v in val.items()}
+    elif isinstance(val, set):
+        return [serialize_value(x) for x in list(val)]
+    elif pd.api.types.is_scalar(val) and pd.isna(val):
+        return None
+    elif isinstance(val, (pd.Period, pd.Timestamp, pd.Interval, datetime.date, datetime.datetime)):
+        return str(val)
+    elif isinstance(val, float):
+        # Handle Python native float infinity and NaN
+        if math.isnan(val) or math.isinf(val):
+            return None
+        return val
+    # Handle any other complex types by converting to string
+    elif hasattr(val, '__dict__') or not isinstance(val, (str, int, bool, type(None))):
+        return str(val)
+    return val
+
+
+def _datetime_strings(values: np.ndarray) -> np.ndarray:
+    """str(Timestamp) of each naive datetime64 value, e.g. '2020-01-01 00:00:00'"""
+    seconds = values.astype("datetime64[s]")
+    strings = np.asarray(pd.DatetimeIndex(seconds).strftime("%Y-%m-%d %H:%M:%S"), dtype=object)
+    fraction = (values - seconds).astype("timedelta64[ns]").astype(np.int64)
+    fraction[np.isnat(values)] = 0
+    # Like Timestamp, show microseconds (and nanoseconds) only where they are not zero
+    for i in np.flatnonzero(fraction):
+        microseconds, nanoseconds = divmod(int(fraction[i]), 1000)
+        strings[i] += f".{microseconds:06d}" + (f"{nanoseconds:03d}" if nanoseconds else "")
+    return strings
+
+
+def serialize_column(values) -> list:
+    """Convert a Series, Index or array to a list of JSON-compatible values"""
+    if isinstance(values, pd.MultiIndex):
+        return [serialize_value(label) for label in values]
+    values = values.array if isinstance(values, (pd.Series, pd.Index)) else values
+    if isinstance(values, pd.arrays.NumpyExtensionArray):
+        values = values.to_numpy()
+    dtype = values.dtype
+
+    if isinstance(dtype, pd.CategoricalDtype):
+        # Serialize each category once, then look rows up by code (-1 is missing)
+        categories = serialize_column(dtype.categories) + [None]
+        return np.array(categories, dtype=object)[values.codes].tolist()
+
+    if isinstance(dtype, np.dtype) and dtype.kind in "iubf":
+        return np.asarray(values).tolist()
+
+    if not isinstance(dtype, np.dtype) and dtype.kind in "iubf":
+        # Nullable extension arrays
+        return values.to_numpy(dtype=object, na_value=None).tolist()
+
+    missing = np.asarray(pd.isna(values))
+    if pd.api.types.is_string_dtype(dtype) and not isinstance(dtype, np.dtype):
+        converted = values.to_numpy(dtype=object, na_value=None)
+    elif dtype == object:
+        converted = np.asarray(values, dtype=object)
+        if pd.api.types.infer_dtype(converted, skipna=True) not in ("string", "empty"):
+            return [serialize_value(val) for val in converted]
+        converted = converted.copy()
+        converted[missing] = None
+    elif isinstance(dtype, np.dtype) and dtype.kind == "M":
+        converted = _datetime_strings(np.asarray(values))
+        converted[missing] = None
+    elif dtype.kind in "mM":
+        # Timedeltas and timezone-aware timestamps, rendered one by one as str() does
+        # (astype(str) picks one resolution for the whole column)
+        converted = np.array([str(value) for value in values], dtype=object)
+        converted[missing] = None
+    else:
+        # Periods and intervals are rendered by pandas
+        converted = np.asarray(values.astype(str), dtype=object)
+        converted[missing] = None
+    return converted.tolist()
+
+
+def _labels(index: pd.Index, sep: str = None) -> list:
+    """String labels of an index; tuples are joined with `sep` when given"""
+    if sep is not None and isinstance(index, pd.MultiIndex):
+        return [sep.join(str(part) for part in label) for label in index]
+    return [str(label) for label in index]
+
+
+def _records(keys: list, columns: list) -> list:
+    return [dict(zip(keys, row)) for row in zip(*columns)]
+
+
+def _hierarchy(index: pd.Index, default_name: str) -> list:
+    if isinstance(index, pd.MultiIndex):
+        return [
+            {
+                "level": level,
+                "name": str(index.names[level] or f"level_{level}"),
+                "values": _labels(index.get_level_values(level).unique()),
+            }
+            for level in range(index.nlevels)
+        ]
+    return [{"level": 0, "name": str(index.name or default_name), "values": _labels(index)}]
+
+
+def _serialize_pivot(result: pd.DataFrame) -> dict:
+    value_columns = [serialize_column(result.iloc[:, i]) for i in range(result.shape[1])]
+    index_columns = [
+        serialize_column(result.index.get_level_values(level))
+        for level in range(result.index.nlevels)
+    ]
+    columns = index_columns + value_columns
+
+    # Index levels become leading columns, named as DataFrame.reset_index names them.
+    # "flat" flattens the column names before resetting the index, "structured"
+    # after it, which pads index names under MultiIndex columns (e.g. "region_")
+    value_keys = _labels(result.columns, "_")
+    n_index = len(index_columns)
+    empty = result.iloc[:0]
+    flat_names = empty.set_axis(value_keys, axis=1).reset_index().columns[:n_index]
+    structured_names = empty.reset_index().columns[:n_index]
+    flat_keys = _labels(flat_names) + value_keys
+    structured_keys = _labels(structured_names, "_") + value_keys
+
+    nested = {}
+    leaf_keys = _labels(result.columns)
+    if isinstance(result.index, pd.MultiIndex):
+        label_columns = [_labels(result.index.get_level_values(level))
+                         for level in range(result.index.nlevels)]
+        for labels, row in zip(zip(*label_columns), zip(*value_columns)):
+            current_level = nested
+            for label in labels[:-1]:
+                current_level = current_level.setdefault(label, {})
+            current_level[labels[-1]] = dict(zip(leaf_keys, row))
+    else:
+        for label, row in zip(_labels(result.index), zip(*value_columns)):
+            nested[label] = dict(zip(leaf_keys, row))
+
+    return {
+        "type": "pivot_table",
+        "data": {
+            "flat": _records(flat_keys, columns),
+            "structured": _records(structured_keys, columns),
+            "nested": nested,
+        },
+        "metadata": {
+            "index_hierarchy": _hierarchy(result.index, "index"),
+            "column_hierarchy": _hierarchy(result.columns, "columns"),
+            "shape": list(result.shape),
+            "columns": _labels(result.columns),
+            "index": _labels(result.index),
+        },
+    }
+
+
+def serialize_result(result) -> dict:
+    """The `output` of a pandas /execute response for any evaluated result"""
+    if isinstance(result, pd.DataFrame):
+        if result.empty:
+            return {"type": "dataframe", "data": []}
+        if isinstance(result.index, pd.MultiIndex) or isinstance(result.columns, pd.MultiIndex):
+            return _serialize_pivot(result)
+        columns = [serialize_column(result.iloc[:, i]) for i in range(result.shape[1])]
+        return {"type": "dataframe", "data": _records(_labels(result.columns), columns)}
+
+    if isinstance(result, pd.Series):
+        if result.empty:
+            return {"type": "series", "data": {}}
+        data = dict(zip(_labels(result.index, "_"), serialize_column(result)))
+        if isinstance(result.index, pd.MultiIndex):
+            return {
+                "type": "series",
+                "data": data,
+                "note": "MultiIndex was flattened for JSON serialization",
+            }
+        return {"type": "series", "data": data}
+
+    if isinstance(result, pd.Index):
+        return {"type": "index", "data": {str(i): val for i, val in enumerate(serialize_column(result))}}
+
+    return {"type": "value", "data": serialize_value(result)}
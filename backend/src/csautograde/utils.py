@@ -4,17 +4,48 @@ import numpy as np
 import textwrap
 import ast
 import io
-import sys
-import sqlite3
-import requests
 import traceback
-import datetime
+from contextlib import redirect_stdout
+from itertools import zip_longest
 import math
+import copy
+import os
+import sqlite3
+import hashlib
+import base64
+import json
+
+from .databases import databases, PRACTICE, QueryAborted
+from .serializer import dumps, serialize_result, serialize_value
+from .result_store import results
+
+class _NotComputed:
+    def __reduce__(self):
+        # Unpickle as the same sentinel, e.g. in a sandbox worker
+        return "NOT_COMPUTED"
+
+    def __repr__(self):
+        return "NOT_COMPUTED"
+
+
+# Passed as `expected` when the solution result has not been precomputed
+NOT_COMPUTED = _NotComputed()
+
+# Absolute tolerance used when comparing numbers
+ATOL = 1e-6
+
+# Rows fetched from each side in the first step of the streaming SQL comparison;
+# later steps double in size up to SQL_COMPARE_MAX_BATCH_ROWS
+SQL_COMPARE_BATCH_ROWS = int(os.getenv("SQL_COMPARE_BATCH_ROWS", 1000))
+SQL_COMPARE_MAX_BATCH_ROWS = int(os.getenv("SQL_COMPARE_MAX_BATCH_ROWS", 32000))
+# Largest solution result still checked inside SQLite first (see `check_sql`);
+# past this, streaming the answer against the precomputed result is cheaper
+SQL_PUSHDOWN_MAX_ROWS = int(os.getenv("SQL_PUSHDOWN_MAX_ROWS", 10000))
 
 
 class Utils:
     # Function to compare numbers or arrays if values are "equal" (or closely equal)
-    is_close = partial(np.isclose, atol=1e-6, equal_nan=True)
+    is_close = partial(np.isclose, atol=ATOL, equal_nan=True)
     DEBUG = True
 
     @classmethod
@@ -22,29 +53,100 @@ class Utils:
         if cls.DEBUG:
             print(msg)
 
+    @staticmethod
+    def _comparison_kind(dtype) -> str:
+        """Classify a dtype as 'bool', 'int', 'float', 'category', 'object' or 'other'"""
+        if isinstance(dtype, pd.CategoricalDtype):
+            return "category"
+        if pd.api.types.is_bool_dtype(dtype):
+            return "bool"
+        if pd.api.types.is_integer_dtype(dtype):
+            return "int"
+        if pd.api.types.is_numeric_dtype(dtype):
+            return "float"
+        if pd.api.types.is_string_dtype(dtype):
+            return "object"
+        return "other"
+
+    @classmethod
+    def _as_comparable(cls, values):
+        """Return (array, kind) for a Series, numpy or pandas extension array"""
+        values = values.values if isinstance(values, pd.Series) else values
+        dtype = values.dtype
+        kind = cls._comparison_kind(dtype)
+        if isinstance(dtype, np.dtype) or kind == "category":
+            return values if kind == "category" else np.asarray(values), kind
+
+        # Nullable/extension arrays: plain numpy dtype when there is no missing value
+        if kind in ("bool", "int", "float"):
+            if values.isna().any():
+                return values.to_numpy(dtype="float64", na_value=np.nan), "float"
+            return values.to_numpy(dtype=dtype.numpy_dtype), kind
+        return values.to_numpy(dtype=object), "object"
+
+    @classmethod
+    def _is_object_array_equal(cls, a_val: np.ndarray, b_val: np.ndarray) -> bool:
+        """Elementwise equality of object arrays where missing values (None/NaN/NaT) match"""
+        try:
+            equal = a_val == b_val
+        except Exception:
+            equal = None
+        if not isinstance(equal, np.ndarray) or equal.shape != a_val.shape:
+            # Elements that do not compare elementwise (e.g. nested arrays)
+            a_val = pd.Series(a_val).fillna("NAN_VALUE").values
+            b_val = pd.Series(b_val).fillna("NAN_VALUE").values
+            return np.array_equal(a_val, b_val)
+
+        if equal.all():
+            return True
+        # Only the mismatching positions need the missing-value check
+        mismatch = ~equal
+        return bool(np.all(pd.isna(a_val[mismatch]) & pd.isna(b_val[mismatch])))
+
+    @classmethod
+    def _is_numeric_close(cls, a_val: np.ndarray, b_val: np.ndarray) -> bool:
+        """`is_close` over whole arrays, applying the tolerance only where values differ"""
+        if a_val.shape != b_val.shape:
+            return False
+        equal = a_val == b_val
+        if equal.all():
+            return True
+        mismatch = ~equal
+        return bool(np.all(cls.is_close(a_val[mismatch], b_val[mismatch])))
+
     @classmethod
     def is_1darray_equal(
         cls, a_val: np.ndarray | pd.Series, b_val: np.ndarray | pd.Series
     ) -> bool:
         """
         Check whether two 1D arrays (or Series) are equal (or closely equal).
-        Handles numeric and string arrays, and replaces NaNs with 'NAN_VALUE' for strings.
+        Integer and boolean arrays are compared exactly, other numeric arrays
+        with `is_close`, and string/object arrays treat missing values as equal.
         """
-        # Convert pandas Series to numpy array if needed
-        a_val = a_val.values if hasattr(a_val, "values") else a_val
-        b_val = b_val.values if hasattr(b_val, "values") else b_val
+        a_val, a_kind = cls._as_comparable(a_val)
+        b_val, b_kind = cls._as_comparable(b_val)
+
+        if len(a_val) != len(b_val):
+            return False
+
+        if a_kind == b_kind == "category" and a_val.dtype == b_val.dtype:
+            return np.array_equal(a_val.codes, b_val.codes)
+        if a_kind == "category":
+            a_val, a_kind = np.asarray(a_val, dtype=object), "object"
+        if b_kind == "category":
+            b_val, b_kind = np.asarray(b_val, dtype=object), "object"
+
+        # Exact fast path for integer and boolean arrays
+        if a_kind == b_kind and a_kind in ("int", "bool"):
+            return np.array_equal(a_val, b_val)
 
         # Handle numeric arrays
-        if np.issubdtype(a_val.dtype, np.number) and np.issubdtype(
-            b_val.dtype, np.number
-        ):
-            return np.all(cls.is_close(a_val, b_val))
+        if a_kind in ("int", "float") and b_kind in ("int", "float"):
+            return cls._is_numeric_close(a_val, b_val)
 
         # Handle string arrays
-        if a_val.dtype.kind in {"U", "S", "O"} and b_val.dtype.kind in {"U", "S", "O"}:
-            # Replace NaN values in string arrays with 'NAN_VALUE'
-            a_val = pd.Series(a_val).fillna("NAN_VALUE").values
-            b_val = pd.Series(b_val).fillna("NAN_VALUE").values
+        if a_kind == b_kind == "object":
+            return cls._is_object_array_equal(a_val, b_val)
 
         return np.array_equal(a_val, b_val)
 
@@ -52,6 +154,8 @@ class Utils:
     def is_df_equal(cls, a_val: pd.DataFrame, b_val: pd.DataFrame, **kwargs) -> bool:
         """
         Check whether two DataFrames are equal in terms of values and optionally column names.
+        Columns are grouped by dtype so that integer/boolean and float columns are
+        each compared as one 2D block; the remaining columns are compared one by one.
         **kwargs:
             - same_col_name (bool): Whether to require identical column names (default: True)
         """
@@ -64,9 +168,36 @@ class Utils:
         if same_col_name and not a_val.columns.equals(b_val.columns):
             return False
 
-        # Check each column (1D array) for equality
-        for col_a, col_b in zip(a_val.columns, b_val.columns):
-            if not cls.is_1darray_equal(a_val[col_a], b_val[col_b]):
+        exact_blocks = {}
+        close_block = []
+        other_columns = []
+        for i, (a_dtype, b_dtype) in enumerate(zip(a_val.dtypes, b_val.dtypes)):
+            a_kind = a_dtype.kind if isinstance(a_dtype, np.dtype) else None
+            b_kind = b_dtype.kind if isinstance(b_dtype, np.dtype) else None
+            if a_kind and b_kind and (
+                (a_kind in "iu" and b_kind in "iu") or a_kind == b_kind == "b"
+            ):
+                exact_blocks.setdefault((a_dtype, b_dtype), []).append(i)
+            elif a_kind and b_kind and a_kind in "iuf" and b_kind in "iuf":
+                close_block.append(i)
+            else:
+                other_columns.append(i)
+
+        # Cheapest checks first: exact integer/boolean blocks, then float blocks
+        for positions in exact_blocks.values():
+            if not np.array_equal(
+                a_val.iloc[:, positions].to_numpy(), b_val.iloc[:, positions].to_numpy()
+            ):
+                return False
+
+        if close_block and not cls._is_numeric_close(
+            a_val.iloc[:, close_block].to_numpy(dtype="float64"),
+            b_val.iloc[:, close_block].to_numpy(dtype="float64"),
+        ):
+            return False
+
+        for i in other_columns:
+            if not cls.is_1darray_equal(a_val.iloc[:, i], b_val.iloc[:, i]):
                 return False
 
         return True
@@ -97,7 +228,89 @@ class Utils:
         return a_val == b_val
 
     @classmethod
-    def check_expression(cls, submission, solution, q_index, global_dict):
+    def _hash_column(cls, digest, values) -> bool:
+        """Feed one 1D column into `digest`; False if it cannot be fingerprinted safely"""
+        values, kind = cls._as_comparable(values)
+        if kind == "category":
+            values, kind = np.asarray(values, dtype=object), "object"
+
+        if kind in ("int", "bool"):
+            if values.dtype == np.uint64:
+                return False
+            data = values.astype(np.int64 if kind == "int" else np.bool_)
+        elif kind == "float":
+            # Quantize to the comparison tolerance so values in the same bucket hash alike
+            with np.errstate(over="ignore", invalid="ignore"):
+                data = np.round(values.astype(np.float64) / ATOL) + 0.0
+            # Infinities, and huge values that overflow to them, would all share one bucket
+            if np.isinf(data).any():
+                return False
+            data[np.isnan(data)] = np.nan
+        elif kind == "object":
+            if pd.api.types.infer_dtype(values, skipna=True) not in ("string", "empty"):
+                return False
+            data = pd.util.hash_array(values)
+        elif values.dtype.kind in "mM" and not np.isnat(values).any():
+            kind = str(values.dtype)
+            data = values.view(np.int64)
+        else:
+            return False
+
+        digest.update(kind.encode())
+        digest.update(np.ascontiguousarray(data).tobytes())
+        return True
+
+    @classmethod
+    def fingerprint(cls, value, names: bool = True) -> str | None:
+        """
+        Tolerance-aware content hash of a result, computed column by column.
+
+        Two values with the same fingerprint are equal under `is_equal`, so a
+        match settles a comparison; a different fingerprint (or None, for values
+        that cannot be hashed safely) still needs the full comparison.
+        `names` includes DataFrame column names, as `is_equal` does by default.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        try:
+            if isinstance(value, (int, float)):
+                if math.isnan(value):
+                    digest.update(b"num:nan")
+                elif math.isinf(value / ATOL):
+                    return None
+                else:
+                    digest.update(f"num:{round(value / ATOL) + 0.0}".encode())
+            elif isinstance(value, str):
+                digest.update(b"str:" + value.encode())
+            elif isinstance(value, (list, tuple, np.ndarray, pd.Series)):
+                values = np.array(value) if isinstance(value, (list, tuple)) else value
+                if values.ndim != 1:
+                    return None
+                prefix = "seq" if isinstance(value, (list, tuple)) else "array"
+                digest.update(f"{prefix}:{len(values)}".encode())
+                if not cls._hash_column(digest, values):
+                    return None
+            elif isinstance(value, pd.DataFrame):
+                digest.update(f"frame:{value.shape}".encode())
+                if names:
+                    digest.update(repr(list(value.columns)).encode())
+                for i in range(value.shape[1]):
+                    if not cls._hash_column(digest, value.iloc[:, i]):
+                        return None
+            else:
+                return None
+        except (ValueError, TypeError, OverflowError):
+            return None
+        return digest.hexdigest()
+
+    @classmethod
+    def check_expression(cls, submission, solution, q_index, global_dict, expected=NOT_COMPUTED,
+                         expected_fingerprint=None):
+        """
+        `expected` is the precomputed result of the solution expression;
+        the solution is only evaluated here when it is not given.
+        A submission whose fingerprint matches `expected_fingerprint` is accepted
+        without the full comparison.
+        """
         if not isinstance(submission, str):
             cls.printt("Your expression answer must be a string")
             return "INVALID"
@@ -118,11 +331,16 @@ class Utils:
                 submission_expr = submission.strip()
 
             # Evaluate both the submission and the solution expressions in the provided global context
-            result_sol = eval(textwrap.dedent(solution), global_dict)
+            if expected is NOT_COMPUTED:
+                result_sol = eval(textwrap.dedent(solution), global_dict)
+            else:
+                result_sol = expected
             result_sub = eval(textwrap.dedent(submission_expr), global_dict)
 
             # Check if the results are closely equal using the existing equality checks
-            if cls.is_equal(result_sol, result_sub):
+            matched = (expected_fingerprint is not None
+                       and cls.fingerprint(result_sub) == expected_fingerprint)
+            if matched or cls.is_equal(result_sol, result_sub):
                 if is_assignment(submission):
                     return "Partial", f"Q{q_index}: Submission is in wrong format"
                 return True, None
@@ -134,11 +352,16 @@ class Utils:
             return False, issue
 
     @classmethod
-    def check_function(cls, submission, solution, q_index, global_dict, tests=None):
+    def check_function(cls, submission, solution, q_index, global_dict, tests=None, expected=None):
+        """
+        `expected` holds the precomputed solution output for each test case;
+        the solution function is only run here when it is not given.
+        """
         try:
             solution = textwrap.dedent(solution)
             exec(submission, global_dict)
-            exec(solution, global_dict)
+            if expected is None:
+                exec(solution, global_dict)
 
             have_other_code = submission[:submission.find('def')].strip() != ""
             submission = submission[submission.find("def"):]
@@ -147,9 +370,13 @@ class Utils:
 
             test_passed = 0
 
-            for test in tests:
-                result_sub = global_dict[func_name_sub](*test)
-                result_sol = global_dict[func_name_sol](*test)
+            for test_index, test in enumerate(tests):
+                # Student code may mutate its arguments, which are shared test data
+                result_sub = global_dict[func_name_sub](*copy.deepcopy(test))
+                if expected is None:
+                    result_sol = global_dict[func_name_sol](*test)
+                else:
+                    result_sol = expected[test_index]
 
                 if not cls.is_equal(result_sub, result_sol):
                     issue = f"Q{q_index}: {test} \nExpected output: {result_sol} \nYour output: {result_sub}"
@@ -165,12 +392,166 @@ class Utils:
             else:
                 return False, None
 
+        except MemoryError:
+            # Reported by the sandbox as a memory budget overrun
+            raise
         except Exception as e:
             issue = f"Q{q_index}: {e}"
             return False, issue
 
+    @staticmethod
+    def _sql_width(query: str, connection) -> int:
+        """Number of result columns of `query`, without running it"""
+        cur = connection.execute(f"SELECT * FROM (\n{query}\n) LIMIT 0")
+        width = len(cur.description)
+        cur.close()
+        return width
+
+    @classmethod
+    def _sql_results_match(cls, answer: str, solution: str, connection) -> bool:
+        """
+        Whether two SQLite queries return the same rows in the same order,
+        decided by the engine without fetching either result: rows are tagged
+        with their position, so equal row counts and an empty EXCEPT mean the
+        results are identical. False when that cannot be shown exactly (values
+        differ, floats that may be within tolerance, queries that cannot be
+        wrapped); the caller then compares the results in pandas.
+        """
+        if not isinstance(connection, sqlite3.Connection):
+            return False
+        sub, sol = (query.strip().rstrip(";") for query in (answer, solution))
+        try:
+            width = cls._sql_width(sub, connection)
+            if width != cls._sql_width(sol, connection):
+                return False
+            names = ", ".join(f"c{i}" for i in range(width))
+            # Compare values exactly, whatever the collation of the source columns
+            binary = ", ".join(f"c{i} COLLATE BINARY" for i in range(width))
+            match = connection.execute(
+                f"WITH s(_rn, {names}) AS (SELECT row_number() OVER (), * FROM (\n{sub}\n)),\n"
+                f"t(_rn, {names}) AS (SELECT row_number() OVER (), * FROM (\n{sol}\n))\n"
+                f"SELECT (SELECT COUNT(*) FROM s) = (SELECT COUNT(*) FROM t) AND NOT EXISTS "
+                f"(SELECT _rn, {binary} FROM s EXCEPT SELECT _rn, {binary} FROM t)"
+            ).fetchone()[0]
+        except QueryAborted:
+            # Over budget already; running it again in pandas would only repeat that
+            raise
+        except sqlite3.Error:
+            return False
+        return bool(match)
+
+    @staticmethod
+    def _batch_sizes():
+        size = SQL_COMPARE_BATCH_ROWS
+        while True:
+            yield size
+            size = min(size * 2, SQL_COMPARE_MAX_BATCH_ROWS)
+
+    @classmethod
+    def _cursor_batches(cls, cursor):
+        """The cursor's rows as DataFrames of `_batch_sizes` rows, fetched lazily"""
+        columns = range(len(cursor.description))
+        for size in cls._batch_sizes():
+            rows = cursor.fetchmany(size)
+            if not rows:
+                return
+            yield pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+
+    @classmethod
+    def _frame_batches(cls, frame: pd.DataFrame):
+        start = 0
+        for size in cls._batch_sizes():
+            if start >= len(frame):
+                return
+            yield frame.iloc[start:start + size].reset_index(drop=True)
+            start += size
+
+    @staticmethod
+    def _align_nulls(sub: pd.DataFrame, sol: pd.DataFrame):
+        """
+        Give a column that is all NULL in one batch the other side's dtype, as
+        it would have in the whole result (None objects next to float NaN, say)
+        """
+        for i in range(min(sub.shape[1], sol.shape[1])):
+            a, b = sub.iloc[:, i], sol.iloc[:, i]
+            if a.dtype == b.dtype:
+                continue
+            for frame, column, other in ((sub, a, b), (sol, b, a)):
+                if column.isna().all():
+                    try:
+                        frame.isetitem(i, column.astype(other.dtype))
+                    except (TypeError, ValueError):
+                        pass
+                    break
+
+    @staticmethod
+    def _row(frame: pd.DataFrame, i: int) -> list:
+        return [value.item() if isinstance(value, np.generic) else value
+                for value in frame.iloc[i]]
+
+    @classmethod
+    def _sql_difference(cls, answer: str, solution: str, connection,
+                        expected=NOT_COMPUTED) -> str | None:
+        """
+        First difference between the answer's rows and the solution's (or the
+        precomputed `expected` result), or None if they are equal.
+
+        Both sides are read in lockstep in growing batches, and each pair of
+        batches is compared like `is_df_equal` compares whole results, so a
+        wrong answer stops after the first batch that differs.
+        """
+        cursors = [connection.cursor()]
+        try:
+            cursors[0].execute(answer)
+            if cursors[0].description is None:
+                return "Your query does not return any rows"
+            width = len(cursors[0].description)
+            if expected is NOT_COMPUTED:
+                cursors.append(connection.cursor())
+                cursors[1].execute(solution)
+                expected_width = len(cursors[1].description)
+                expected_batches = cls._cursor_batches(cursors[1])
+            else:
+                expected_width = expected.shape[1]
+                expected_batches = cls._frame_batches(expected)
+            if width != expected_width:
+                return f"Expected {expected_width} columns, your output has {width}"
+
+            position = 0
+            for sub, sol in zip_longest(cls._cursor_batches(cursors[0]), expected_batches):
+                sub = sub if sub is not None else sol.iloc[:0]
+                sol = sol if sol is not None else sub.iloc[:0]
+                n = min(len(sub), len(sol))
+                cls._align_nulls(sub, sol)
+                if not cls.is_df_equal(sub.iloc[:n], sol.iloc[:n], same_col_name=False):
+                    row = next(i for i in range(n) if not cls.is_df_equal(
+                        sub.iloc[[i]], sol.iloc[[i]], same_col_name=False))
+                    return (f"First difference at row {position + row + 1}:\n"
+                            f"Expected: {cls._row(sol, row)}\n"
+                            f"Your output: {cls._row(sub, row)}")
+                if len(sub) > n:
+                    return (f"Your output has more rows than expected ({position + n}); "
+                            f"first extra row: {cls._row(sub, n)}")
+                if len(sol) > n:
+                    return (f"Your output has only {position + n} rows; "
+                            f"expected row {position + n + 1}: {cls._row(sol, n)}")
+                position += n
+            return None
+        finally:
+            for cursor in cursors:
+                cursor.close()
+
     @classmethod
-    def check_sql(cls, answer, solution, q_index, connection=None):
+    def check_sql(cls, answer, solution, q_index, connection=None, expected=NOT_COMPUTED):
+        """
+        `expected` is the precomputed solution result set;
+        the solution query is only run here when it is not given.
+        When the solution result is unknown or at most SQL_PUSHDOWN_MAX_ROWS
+        rows, an answer returning exactly the solution's rows is accepted by
+        SQLite itself, without fetching either result. Otherwise the answer is
+        streamed and compared with the solution result batch by batch up to the
+        first difference.
+        """
         if not connection:
             cls.printt("No database connection input")
             return "INVALID"
@@ -180,11 +561,12 @@ class Utils:
             return "INVALID"
 
         try:
-            df_sub = pd.read_sql_query(answer, connection)
-            df_sol = pd.read_sql_query(solution, connection)
-            if not cls.is_df_equal(df_sub, df_sol, same_col_name=False):
-                issue = f"Q{q_index}:\nExpected output:\n {df_sol} \nYour output:\n {df_sub}\n"
-                return False, issue
+            if ((expected is NOT_COMPUTED or len(expected) <= SQL_PUSHDOWN_MAX_ROWS)
+                    and cls._sql_results_match(answer, solution, connection)):
+                return True, None
+            difference = cls._sql_difference(answer, solution, connection, expected)
+            if difference is not None:
+                return False, f"Q{q_index}:\n{difference}\n"
             return True, None
         except Exception as e:
             error_str = str(e)
@@ -204,6 +586,15 @@ class Utils:
             issue = f"Q{q_index}: {error_msg}"
             return False, issue
 
+    @classmethod
+    def function_outputs(cls, solution, tests):
+        """Output of the solution function for each test case"""
+        solution = textwrap.dedent(solution)
+        global_dict = {}
+        exec(solution, global_dict)
+        func_name_sol = solution.split("(")[0][4:].strip()
+        return [global_dict[func_name_sol](*copy.deepcopy(test)) for test in tests]
+
     @classmethod
     def check_multichoice(cls, answer, solution, q_index):
         if isinstance(solution, list):
@@ -224,15 +615,16 @@ class Utils:
         """
         try:
             output_buffer = io.StringIO()
-            sys.stdout = output_buffer
-
-            exec(textwrap.dedent(code), global_dict)
+            with redirect_stdout(output_buffer):
+                exec(textwrap.dedent(code), global_dict)
 
-            sys.stdout = sys.__stdout__
             output = output_buffer.getvalue()
 
             return {"success": True, "output": output, "error": None}
 
+        except MemoryError:
+            # Reported by the sandbox as a memory budget overrun
+            raise
         except Exception:
             error_msg = traceback.format_exc()
 
@@ -245,21 +637,30 @@ class Utils:
             return {"success": False, "output": None, "error": error_msg}
 
     @classmethod
-    def execute_expression(cls, expression: str, global_dict):
+    def execute_expression(cls, expression: str, global_dict, user_id: str = None, page_size: int = None,
+                           store=results):
         """
         Execute pandas expression and return the result with appropriate metadata
 
         Args:
             expression: Pandas expression to evaluate
             global_dict: Global dictionary containing the dataframe and other variables
+            user_id: Owner of the stored result when it is longer than `page_size`
+            page_size: Number of rows returned for DataFrame/Series results; longer
+                results are kept in the result store and get a `handle` for paging
+            store: Result store for longer results; with None the whole result is
+                returned under "result" for the caller to store
 
         Returns:
             Dict containing execution results or error message
         """
-        # Capture output in case the expression prints something
-        output_buffer = io.StringIO()
-        sys.stdout = output_buffer
-        
+        # Swallow anything the expression prints; the previous stdout comes back
+        # on every exit, including a budget overrun raised inside the expression
+        with redirect_stdout(io.StringIO()):
+            return cls._evaluate_expression(expression, global_dict, user_id, page_size, store)
+
+    @classmethod
+    def _evaluate_expression(cls, expression: str, global_dict, user_id, page_size, store):
         try:
             # Enhanced handling for multi-line or complex pandas expressions
             # This approach supports pivot_table, groupby, and other multi-line operations
@@ -280,15 +681,10 @@ class Utils:
                     if "__result" in local_vars:
                         result = local_vars["__result"]
                         
-                        # Skip to result serialization
-                        sys.stdout = sys.__stdout__
-                        
                         # Return the result and exit early
-                        return cls._handle_pandas_result(result)
+                        return cls._handle_pandas_result(result, user_id, page_size, store)
                 except Exception as e:
                     # If our special handling fails, continue with normal processing
-                    # Reset stdout for normal processing path
-                    sys.stdout = output_buffer
                     # Log the error for debugging
                     cls.printt(f"Special handling for multi-line expression failed: {str(e)}")
             
@@ -372,7 +768,6 @@ class Utils:
                                 raise Exception(f"Failed to evaluate groupby expression: {str(e)}")
                         except Exception as groupby_err:
                             # If that still fails, give up and return the error
-                            sys.stdout = sys.__stdout__
                             error_msg = f"Error evaluating groupby expression: {str(groupby_err)}\n{traceback.format_exc()}"
                             return {
                                 "success": False,
@@ -381,7 +776,6 @@ class Utils:
                             }
                     else:
                         # For other types of errors, return the error directly
-                        sys.stdout = sys.__stdout__
                         error_msg = f"Error evaluating expression: {str(e)}\n{traceback.format_exc()}"
                         return {
                             "success": False,
@@ -430,410 +824,9 @@ class Utils:
                         "error": f"Error handling GroupBy object: {str(e)}\n{traceback.format_exc()}"
                     }
                 
-            # Reset stdout before handling serialization
-            sys.stdout = sys.__stdout__
-            
-            # Define function for serializing values to ensure JSON compatibility
-            def serialize_value(val):
-                # Handle various data types for JSON serialization
-                if isinstance(val, (np.integer, np.int64)):
-                    return int(val)
-                elif isinstance(val, (np.floating, np.float64)):
-                    # Handle infinity and NaN values properly
-                    if np.isnan(val) or np.isinf(val):
-                        return None
-                    return float(val)
-                elif isinstance(val, (np.bool_)):
-                    return bool(val)
-                elif pd.isna(val):
-                    return None
-                elif isinstance(val, np.ndarray):
-                    return [serialize_value(x) for x in val.tolist()]
-                elif isinstance(val, (pd.Period, pd.Timestamp)):
-                    return str(val)
-                elif isinstance(val, (pd.Interval)):
-                    return str(val)
-                elif isinstance(val, (datetime.date, datetime.datetime)):
-                    return str(val)
-                elif isinstance(val, (tuple, list)):
-                    return [serialize_value(x) for x in val]
-                elif isinstance(val, dict):
-                    return {str(k): serialize_value(v) for k, v in val.items()}
-                elif isinstance(val, set):
-                    return [serialize_value(x) for x in list(val)]
-                elif isinstance(val, float):
-                    # Handle Python native float infinity and NaN
-                    if math.isnan(val) or math.isinf(val):
-                        return None
-                    return val
-                # Handle any other complex types by converting to string
-                elif hasattr(val, '__dict__') or not isinstance(val, (str, int, bool, type(None))):
-                    return str(val)
-                return val
-            
-            # Handle different result types
-            if isinstance(result, pd.DataFrame):
-                if result.empty:
-                    return {
-                        "success": True,
-                        "output": {
-                            "type": "dataframe",
-                            "data": []
-                        },
-                        "error": None
-                    }
-                
-                # Handle MultiIndex columns or index
-                if isinstance(result.index, pd.MultiIndex) or isinstance(result.columns, pd.MultiIndex):
-                    # Create a more structured representation for pivot tables
-                    # This format will be easier to render in frontend tables
-                    
-                    # Get column hierarchy information
-                    column_hierarchy = []
-                    if isinstance(result.columns, pd.MultiIndex):
-                        # Extract the levels from MultiIndex columns
-                        for level_idx in range(result.columns.nlevels):
-                            level_values = result.columns.get_level_values(level_idx).unique()
-                            column_hierarchy.append({
-                                "level": level_idx,
-                                "name": str(result.columns.names[level_idx] or f"level_{level_idx}"),
-                                "values": [str(val) for val in level_values]
-                            })
-                    else:
-                        # Single level columns
-                        column_hierarchy.append({
-                            "level": 0,
-                            "name": str(result.columns.name or "columns"),
-                            "values": [str(col) for col in result.columns]
-                        })
-                    
-                    # Get index hierarchy information
-                    index_hierarchy = []
-                    if isinstance(result.index, pd.MultiIndex):
-                        # Extract the levels from MultiIndex index
-                        for level_idx in range(result.index.nlevels):
-                            level_values = result.index.get_level_values(level_idx).unique()
-                            index_hierarchy.append({
-                                "level": level_idx,
-                                "name": str(result.index.names[level_idx] or f"level_{level_idx}"),
-                                "values": [str(val) for val in level_values]
-                            })
-                    else:
-                        # Single level index
-                        index_hierarchy.append({
-                            "level": 0,
-                            "name": str(result.index.name or "index"),
-                            "values": [str(idx) for idx in result.index]
-                        })
-                    
-                    # Format 1: Convert to dictionary for JSON serialization (flattened version)
-                    flat_df_dict = []
-                    result_copy = result.copy()
-                    
-                    # Convert MultiIndex columns to strings
-                    if isinstance(result.columns, pd.MultiIndex):
-                        result_copy.columns = ['_'.join([str(col) for col in col_tuple]) 
-                                          if isinstance(col_tuple, tuple) else str(col_tuple) 
-                                          for col_tuple in result.columns]
-                    
-                    # Reset index to convert MultiIndex to columns
-                    if isinstance(result.index, pd.MultiIndex):
-                        result_copy = result_copy.reset_index()
-                    else:
-                        # For regular index, make it a column
-                        result_copy = result_copy.reset_index()
-                    
-                    # Create the flattened records
-                    for i in range(len(result_copy)):
-                        row_dict = {}
-                        for col in result_copy.columns:
-                            try:
-                                val = result_copy.iloc[i][col]
-                                if isinstance(val, float) and (math.isnan(val) or math.isinf(val)):
-                                    row_dict[str(col)] = None
-                                else:
-                                    row_dict[str(col)] = serialize_value(val)
-                            except Exception:
-                                row_dict[str(col)] = None
-                        flat_df_dict.append(row_dict)
-                    
-                    # Format 2: Create a structured format that preserves the pivot table hierarchy
-                    # First, reset the index to get all data as regular columns
-                    structured_data_frame = result.reset_index()
-                    
-                    # Handle potential multi-level columns in the result
-                    if isinstance(structured_data_frame.columns, pd.MultiIndex):
-                        structured_data_frame.columns = [
-                            '_'.join([str(col) for col in col_tuple]) 
-                            if isinstance(col_tuple, tuple) else str(col_tuple) 
-                            for col_tuple in structured_data_frame.columns
-                        ]
-                    
-                    # Convert to records safely
-                    structured_data = []
-                    for _, row in structured_data_frame.iterrows():
-                        row_dict = {}
-                        for col in structured_data_frame.columns:
-                            val = row[col]
-                            # Ensure all keys are strings
-                            row_dict[str(col)] = serialize_value(val)
-                        structured_data.append(row_dict)
-                    
-                    # Format 3: Create a nested data structure
-                    # Convert to a more complex but hierarchical structure
-                    nested_data = {}
-                    
-                    if isinstance(result.index, pd.MultiIndex):
-                        # For MultiIndex index, create a nested structure
-                        for idx, row in result.iterrows():
-                            current_level = nested_data
-                            
-                            # Navigate through the index levels
-                            for i, idx_val in enumerate(idx[:-1] if isinstance(idx, tuple) else [idx]):
-                                str_idx_val = str(idx_val)
-                                if str_idx_val not in current_level:
-                                    current_level[str_idx_val] = {}
-                                current_level = current_level[str_idx_val]
-                            
-                            # Set the innermost level with the row data
-                            last_idx = idx[-1] if isinstance(idx, tuple) else idx
-                            current_level[str(last_idx)] = {
-                                str(col): serialize_value(val) 
-                                for col, val in row.items()
-                            }
-                    else:
-                        # For regular index, create a simple structure
-                        for idx, row in result.iterrows():
-                            nested_data[str(idx)] = {
-                                str(col): serialize_value(val) 
-                                for col, val in row.items()
-                            }
-                    
-                    # Return structured formats for flexibility in frontend rendering
-                    return {
-                        "success": True,
-                        "output": {
-                            "type": "pivot_table",
-                            "data": {
-                                "flat": flat_df_dict,             # Format 1: Flattened records
-                                "structured": structured_data,    # Format 2: Structured records
-                                "nested": nested_data,            # Format 3: Nested hierarchy
-                            },
-                            "metadata": {
-                                "index_hierarchy": index_hierarchy,
-                                "column_hierarchy": column_hierarchy,
-                                "shape": list(result.shape),
-                                "columns": [str(col) for col in result.columns],
-                                "index": [str(idx) for idx in result.index]
-                            }
-                        },
-                        "error": None
-                    }
-                else:
-                    # Regular DataFrame
-                    df_dict = []
-                    for i in range(len(result)):
-                        row_dict = {}
-                        for col in result.columns:
-                            try:
-                                val = result.iloc[i][col]
-                                # Additional check for NaN/inf values at the DataFrame level
-                                if isinstance(val, float) and (math.isnan(val) or math.isinf(val)):
-                                    row_dict[str(col)] = None
-                                else:
-                                    row_dict[str(col)] = serialize_value(val)
-                            except Exception:
-                                # If serialization fails, set to None
-                                row_dict[str(col)] = None
-                        df_dict.append(row_dict)
-                    
-                    return {
-                        "success": True,
-                        "output": {
-                            "type": "dataframe",
-                            "data": df_dict
-                        },
-                        "error": None
-                    }
-        
-            elif isinstance(result, pd.Series):
-                # Handle Series with proper serialization
-                if result.empty:
-                    return {
-                        "success": True,
-                        "output": {
-                            "type": "series",
-                            "data": {}
-                        },
-                        "error": None
-                    }
-                
-                # Handle Series with MultiIndex
-                if isinstance(result.index, pd.MultiIndex):
-                    # Convert index to strings
-                    result_dict = {}
-                    for idx, val in result.items():
-                        # Convert MultiIndex tuple to string
-                        if isinstance(idx, tuple):
-                            str_idx = '_'.join([str(i) for i in idx])
-                        else:
-                            str_idx = str(idx)
-                        result_dict[str_idx] = serialize_value(val)
-                
-                    return {
-                        "success": True,
-                        "output": {
-                            "type": "series",
-                            "data": result_dict,
-                            "note": "MultiIndex was flattened for JSON serialization"
-                        },
-                        "error": None
-                    }
-                else:
-                    # Regular Series
-                    series_dict = {}
-                    for idx, val in result.items():
-                        try:
-                            # Additional check for NaN/inf values
-                            if isinstance(val, float) and (math.isnan(val) or math.isinf(val)):
-                                series_dict[str(idx)] = None
-                            else:
-                                series_dict[str(idx)] = serialize_value(val)
-                        except Exception:
-                            # If serialization fails, set to None
-                            series_dict[str(idx)] = None
-                    
-                    return {
-                        "success": True,
-                        "output": {
-                            "type": "series",
-                            "data": series_dict
-                        },
-                        "error": None
-                    }
-        
-            # Handle pandas Index objects
-            elif isinstance(result, pd.Index):
-                index_dict = {str(i): serialize_value(val) for i, val in enumerate(result)}
-                
-                return {
-                    "success": True,
-                    "output": {
-                        "type": "index",
-                        "data": index_dict
-                    },
-                    "error": None
-                }
-            
-            # Handle pandas GroupBy objects by evaluating the full expression directly
-            elif str(type(result)).startswith("<class 'pandas.core.groupby"):
-                try:
-                    # Try evaluating the full expression directly
-                    full_result = eval(expression, global_dict, local_vars)
-                    
-                    # Return the serialized full result
-                    if isinstance(full_result, pd.DataFrame):
-                        # Use the DataFrame handling branch that's already defined below
-                        if full_result.empty:
-                            return {
-                                "success": True,
-                                "output": {
-                                    "type": "dataframe",
-                                    "data": []
-                                },
-                                "error": None
-                            }
-                        
-                        # Create serialized data
-                        df_dict = []
-                        for i in range(len(full_result)):
-                            row_dict = {}
-                            for col in full_result.columns:
-                                try:
-                                    val = full_result.iloc[i][col]
-                                    # Additional check for NaN/inf values at the DataFrame level
-                                    if isinstance(val, float) and (math.isnan(val) or math.isinf(val)):
-                                        row_dict[str(col)] = None
-                                    else:
-                                        row_dict[str(col)] = serialize_value(val)
-                                except Exception:
-                                    # If serialization fails, set to None
-                                    row_dict[str(col)] = None
-                        df_dict.append(row_dict)
-                        
-                        return {
-                            "success": True,
-                            "output": {
-                                "type": "dataframe",
-                                "data": df_dict
-                            },
-                            "error": None
-                        }
-                    elif isinstance(full_result, pd.Series):
-                        # Use the Series handling branch
-                        if full_result.empty:
-                            return {
-                                "success": True,
-                                "output": {
-                                    "type": "series",
-                                    "data": {}
-                                },
-                                "error": None
-                            }
-                        
-                        # Regular Series
-                        series_dict = {}
-                        for idx, val in full_result.items():
-                            try:
-                                # Additional check for NaN/inf values
-                                if isinstance(val, float) and (math.isnan(val) or math.isinf(val)):
-                                    series_dict[str(idx)] = None
-                                else:
-                                    series_dict[str(idx)] = serialize_value(val)
-                            except Exception:
-                                # If serialization fails, set to None
-                                series_dict[str(idx)] = None
-                        
-                        return {
-                            "success": True,
-                            "output": {
-                                "type": "series",
-                                "data": series_dict
-                            },
-                            "error": None
-                        }
-                    else:
-                        # Handle any other type
-                        return {
-                            "success": True,
-                            "output": {
-                                "type": "value",
-                                "data": serialize_value(full_result)
-                            },
-                            "error": None
-                        }
-                except Exception as e:
-                    return {
-                        "success": False,
-                        "output": None,
-                        "error": f"Error evaluating GroupBy expression: {str(e)}\n{traceback.format_exc()}"
-                    }
-                
-            # Handle other pandas objects or any other Python values
-            else:
-                return {
-                    "success": True,
-                    "output": {
-                        "type": "value",
-                        "data": serialize_value(result)
-                    },
-                    "error": None
-                }
+            return cls._handle_pandas_result(result, user_id, page_size, store)
 
         except Exception:
-            # Reset stdout
-            sys.stdout = sys.__stdout__
-            
             # Return detailed error message
             error_msg = traceback.format_exc()
             return {
@@ -843,408 +836,169 @@ class Utils:
             }
 
     @classmethod
-    def _handle_pandas_result(cls, result):
-        # Define function for serializing values to ensure JSON compatibility
-        def serialize_value(val):
-            # Handle various data types for JSON serialization
-            if isinstance(val, (np.integer, np.int64)):
-                return int(val)
-            elif isinstance(val, (np.floating, np.float64)):
-                # Handle infinity and NaN values properly
-                if np.isnan(val) or np.isinf(val):
-                    return None
-                return float(val)
-            elif isinstance(val, (np.bool_)):
-                return bool(val)
-            elif pd.isna(val):
-                return None
-            elif isinstance(val, np.ndarray):
-                return [serialize_value(x) for x in val.tolist()]
-            elif isinstance(val, (pd.Period, pd.Timestamp)):
-                return str(val)
-            elif isinstance(val, (pd.Interval)):
-                return str(val)
-            elif isinstance(val, (datetime.date, datetime.datetime)):
-                return str(val)
-            elif isinstance(val, (tuple, list)):
-                return [serialize_value(x) for x in val]
-            elif isinstance(val, dict):
-                return {str(k): serialize_value(v) for k, v in val.items()}
-            elif isinstance(val, set):
-                return [serialize_value(x) for x in list(val)]
-            elif isinstance(val, float):
-                # Handle Python native float infinity and NaN
-                if math.isnan(val) or math.isinf(val):
-                    return None
-                return val
-            # Handle any other complex types by converting to string
-            elif hasattr(val, '__dict__') or not isinstance(val, (str, int, bool, type(None))):
-                return str(val)
-            return val
-        
-        # Handle different result types
-        if isinstance(result, pd.DataFrame):
-            if result.empty:
-                return {
-                    "success": True,
-                    "output": {
-                        "type": "dataframe",
-                        "data": []
-                    },
-                    "error": None
-                }
-            
-            # Handle MultiIndex columns or index
-            if isinstance(result.index, pd.MultiIndex) or isinstance(result.columns, pd.MultiIndex):
-                # Create a more structured representation for pivot tables
-                # This format will be easier to render in frontend tables
-                
-                # Get column hierarchy information
-                column_hierarchy = []
-                if isinstance(result.columns, pd.MultiIndex):
-                    # Extract the levels from MultiIndex columns
-                    for level_idx in range(result.columns.nlevels):
-                        level_values = result.columns.get_level_values(level_idx).unique()
-                        column_hierarchy.append({
-                            "level": level_idx,
-                            "name": str(result.columns.names[level_idx] or f"level_{level_idx}"),
-                            "values": [str(val) for val in level_values]
-                        })
-                else:
-                    # Single level columns
-                    column_hierarchy.append({
-                        "level": 0,
-                        "name": str(result.columns.name or "columns"),
-                        "values": [str(col) for col in result.columns]
-                    })
-                
-                # Get index hierarchy information
-                index_hierarchy = []
-                if isinstance(result.index, pd.MultiIndex):
-                    # Extract the levels from MultiIndex index
-                    for level_idx in range(result.index.nlevels):
-                        level_values = result.index.get_level_values(level_idx).unique()
-                        index_hierarchy.append({
-                            "level": level_idx,
-                            "name": str(result.index.names[level_idx] or f"level_{level_idx}"),
-                            "values": [str(val) for val in level_values]
-                        })
-                else:
-                    # Single level index
-                    index_hierarchy.append({
-                        "level": 0,
-                        "name": str(result.index.name or "index"),
-                        "values": [str(idx) for idx in result.index]
-                    })
-                
-                # Format 1: Convert to dictionary for JSON serialization (flattened version)
-                flat_df_dict = []
-                result_copy = result.copy()
-                
-                # Convert MultiIndex columns to strings
-                if isinstance(result.columns, pd.MultiIndex):
-                    result_copy.columns = ['_'.join([str(col) for col in col_tuple]) 
-                                      if isinstance(col_tuple, tuple) else str(col_tuple) 
-                                      for col_tuple in result.columns]
-                
-                # Reset index to convert MultiIndex to columns
-                if isinstance(result.index, pd.MultiIndex):
-                    result_copy = result_copy.reset_index()
-                else:
-                    # For regular index, make it a column
-                    result_copy = result_copy.reset_index()
-                
-                # Create the flattened records
-                for i in range(len(result_copy)):
-                    row_dict = {}
-                    for col in result_copy.columns:
-                        try:
-                            val = result_copy.iloc[i][col]
-                            if isinstance(val, float) and (math.isnan(val) or math.isinf(val)):
-                                row_dict[str(col)] = None
-                            else:
-                                row_dict[str(col)] = serialize_value(val)
-                        except Exception:
-                            row_dict[str(col)] = None
-                    flat_df_dict.append(row_dict)
-                
-                # Format 2: Create a structured format that preserves the pivot table hierarchy
-                # First, reset the index to get all data as regular columns
-                structured_data_frame = result.reset_index()
-                
-                # Handle potential multi-level columns in the result
-                if isinstance(structured_data_frame.columns, pd.MultiIndex):
-                    structured_data_frame.columns = [
-                        '_'.join([str(col) for col in col_tuple]) 
-                        if isinstance(col_tuple, tuple) else str(col_tuple) 
-                        for col_tuple in structured_data_frame.columns
-                    ]
-                
-                # Convert to records safely
-                structured_data = []
-                for _, row in structured_data_frame.iterrows():
-                    row_dict = {}
-                    for col in structured_data_frame.columns:
-                        val = row[col]
-                        # Ensure all keys are strings
-                        row_dict[str(col)] = serialize_value(val)
-                    structured_data.append(row_dict)
-                
-                # Format 3: Create a nested data structure
-                # Convert to a more complex but hierarchical structure
-                nested_data = {}
-                
-                if isinstance(result.index, pd.MultiIndex):
-                    # For MultiIndex index, create a nested structure
-                    for idx, row in result.iterrows():
-                        current_level = nested_data
-                        
-                        # Navigate through the index levels
-                        for i, idx_val in enumerate(idx[:-1] if isinstance(idx, tuple) else [idx]):
-                            str_idx_val = str(idx_val)
-                            if str_idx_val not in current_level:
-                                current_level[str_idx_val] = {}
-                            current_level = current_level[str_idx_val]
-                        
-                        # Set the innermost level with the row data
-                        last_idx = idx[-1] if isinstance(idx, tuple) else idx
-                        current_level[str(last_idx)] = {
-                            str(col): serialize_value(val) 
-                            for col, val in row.items()
-                        }
-                else:
-                    # For regular index, create a simple structure
-                    for idx, row in result.iterrows():
-                        nested_data[str(idx)] = {
-                            str(col): serialize_value(val) 
-                            for col, val in row.items()
-                        }
-                
-                # Return structured formats for flexibility in frontend rendering
-                return {
-                    "success": True,
-                    "output": {
-                        "type": "pivot_table",
-                        "data": {
-                            "flat": flat_df_dict,             # Format 1: Flattened records
-                            "structured": structured_data,    # Format 2: Structured records
-                            "nested": nested_data,            # Format 3: Nested hierarchy
-                        },
-                        "metadata": {
-                            "index_hierarchy": index_hierarchy,
-                            "column_hierarchy": column_hierarchy,
-                            "shape": list(result.shape),
-                            "columns": [str(col) for col in result.columns],
-                            "index": [str(idx) for idx in result.index]
-                        }
-                    },
-                    "error": None
-                }
-            else:
-                # Regular DataFrame
-                df_dict = []
-                for i in range(len(result)):
-                    row_dict = {}
-                    for col in result.columns:
-                        try:
-                            val = result.iloc[i][col]
-                            # Additional check for NaN/inf values at the DataFrame level
-                            if isinstance(val, float) and (math.isnan(val) or math.isinf(val)):
-                                row_dict[str(col)] = None
-                            else:
-                                row_dict[str(col)] = serialize_value(val)
-                        except Exception:
-                            # If serialization fails, set to None
-                            row_dict[str(col)] = None
-                    df_dict.append(row_dict)
-                
-                return {
-                    "success": True,
-                    "output": {
-                        "type": "dataframe",
-                        "data": df_dict
-                    },
-                    "error": None
-                }
-        
-        elif isinstance(result, pd.Series):
-            # Handle Series with proper serialization
-            if result.empty:
-                return {
-                    "success": True,
-                    "output": {
-                        "type": "series",
-                        "data": {}
-                    },
-                    "error": None
-                }
-            
-            # Handle Series with MultiIndex
-            if isinstance(result.index, pd.MultiIndex):
-                # Convert index to strings
-                result_dict = {}
-                for idx, val in result.items():
-                    # Convert MultiIndex tuple to string
-                    if isinstance(idx, tuple):
-                        str_idx = '_'.join([str(i) for i in idx])
-                    else:
-                        str_idx = str(idx)
-                    result_dict[str_idx] = serialize_value(val)
-                
-                return {
-                    "success": True,
-                    "output": {
-                        "type": "series",
-                        "data": result_dict,
-                        "note": "MultiIndex was flattened for JSON serialization"
-                    },
-                    "error": None
-                }
-            else:
-                # Regular Series
-                series_dict = {}
-                for idx, val in result.items():
-                    try:
-                        # Additional check for NaN/inf values
-                        if isinstance(val, float) and (math.isnan(val) or math.isinf(val)):
-                            series_dict[str(idx)] = None
-                        else:
-                            series_dict[str(idx)] = serialize_value(val)
-                    except Exception:
-                        # If serialization fails, set to None
-                        series_dict[str(idx)] = None
-                
-                return {
-                    "success": True,
-                    "output": {
-                        "type": "series",
-                        "data": series_dict
-                    },
-                    "error": None
-                }
-        
-        # Handle pandas Index objects
-        elif isinstance(result, pd.Index):
-            index_dict = {str(i): serialize_value(val) for i, val in enumerate(result)}
-            
-            return {
-                "success": True,
-                "output": {
-                    "type": "index",
-                    "data": index_dict
-                },
-                "error": None
-            }
-        
-        # Handle other pandas objects or any other Python values
-        else:
-            return {
+    def _handle_pandas_result(cls, result, user_id: str = None, page_size: int = None,
+                              store=results):
+        if (page_size and isinstance(result, (pd.DataFrame, pd.Series))
+                and len(result) > page_size):
+            page = {
                 "success": True,
-                "output": {
-                    "type": "value",
-                    "data": serialize_value(result)
-                },
+                "output": serialize_result(result.iloc[:page_size]),
+                "total_rows": len(result),
                 "error": None
             }
+            if store is None:
+                page["result"] = result
+            else:
+                page["handle"] = store.put(user_id, result)
+            return page
+        return {
+            "success": True,
+            "output": serialize_result(result),
+            "error": None
+        }
+
+    @staticmethod
+    def _query_error():
+        """Short traceback of the failing SQL statement, without backend internals"""
+        error_msg = traceback.format_exc()
+
+        lines = [line for line in error_msg.split('\n') if line.strip()]
+        error_msg = (
+            "Traceback (most recent call last):\n"
+            '  File "pandas/io/sql.py", in execute\n'
+            "    cur.execute(sql, *args)\n"
+        )
+        # The last SQLite error is the one raised to the caller
+        line = next((line for line in reversed(lines) if 'sqlite3.OperationalError' in line
+                     or 'QueryAborted: ' in line), lines[-1])
+        if 'QueryAborted: ' in line:
+            # Budget aborts read like any other SQLite error
+            line = "sqlite3.OperationalError: " + line.split('QueryAborted: ', 1)[1]
+        error_msg += line
+        return error_msg
+
+    @staticmethod
+    def _query_digest(query: str, database: str) -> str:
+        return hashlib.sha256(f"{database}\0{query}".encode()).hexdigest()[:16]
 
     @classmethod
-    def execute_query(cls, query: str, database: str, connection=None):
+    def encode_cursor(cls, query: str, database: str, offset: int) -> str:
+        """
+        Opaque continuation token for the rows of `query` after `offset`.
+
+        Queries are arbitrary SQL with no key to resume from, so each page runs
+        the query again and skips `offset` rows: reading a whole result page by
+        page costs O(rows² / page_size). /execute/stream reads it in one pass.
         """
-        Execute SQL query and return the result
+        token = json.dumps({"d": cls._query_digest(query, database), "o": offset})
+        return base64.urlsafe_b64encode(token.encode()).decode().rstrip("=")
+
+    @classmethod
+    def decode_cursor(cls, cursor: str, query: str, database: str) -> int:
+        """Offset of a continuation token; ValueError if it is invalid"""
+        try:
+            token = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+            digest, offset = token["d"], int(token["o"])
+        except Exception:
+            raise ValueError("Invalid cursor")
+        if digest != cls._query_digest(query, database) or offset < 0:
+            raise ValueError("Cursor does not belong to this query")
+        return offset
+
+    @classmethod
+    def execute_query(cls, query: str, database: str, connection=None,
+                      page_size: int = 1000, cursor: str = None):
+        """
+        Execute SQL query and return one page of the result
 
         Args:
             query: SQL query string
+            database: Name of the course database (chinook, northwind)
             connection: Database connection object
+            page_size: Maximum number of rows to return
+            cursor: Continuation token from a previous page of the same query
 
         Returns:
-            Dict containing execution results or error message
+            Dict containing the page of rows (records), column names, the total
+            row count (only known on the last page; counting up front would run
+            the whole query) and the token for the next page (None on the last
+            page), or an error message
         """
+        if connection is None and database not in databases.DATABASES:
+            return {
+                "success": False,
+                "output": None,
+                "error": "Could not establish database connection"
+            }
+
         try:
-            conn = connection or cls._connect_to_db(database)
-            if not conn:
-                return {
-                    "success": False,
-                    "output": None,
-                    "error": "Could not establish database connection"
-                }
+            offset = cls.decode_cursor(cursor, query, database) if cursor else 0
+        except ValueError as e:
+            return {"success": False, "output": None, "error": str(e)}
 
-            df = pd.read_sql_query(query, conn)
+        conn = connection or databases.acquire(database, budget=PRACTICE)
+        try:
+            cur = conn.execute(query)
+            columns = [column[0] for column in cur.description or []]
 
-            if connection:
-                conn.close()
+            # Skip the rows of previous pages without keeping them
+            skipped = 0
+            while skipped < offset:
+                chunk = cur.fetchmany(min(offset - skipped, 10000))
+                if not chunk:
+                    break
+                skipped += len(chunk)
+
+            rows = cur.fetchmany(page_size)
+            has_more = cur.fetchone() is not None
+            cur.close()
 
             return {
                 "success": True,
-                "output": df.to_dict(orient='records'),
+                "output": [dict(zip(columns, row)) for row in rows],
+                "columns": columns,
+                "total_rows_estimate": None if has_more else offset + len(rows),
+                "cursor": cls.encode_cursor(
+                    query, database, offset + len(rows)) if has_more else None,
                 "error": None
             }
 
         except Exception:
-            error_msg = traceback.format_exc()
-
-            lines = error_msg.split('\n')
-            error_msg = (
-                "Traceback (most recent call last):\n"
-                '  File "pandas/io/sql.py", in execute\n'
-                "    cur.execute(sql, *args)\n"
-            )
-            error_msg += next(line for line in lines if 'sqlite3.OperationalError' in line)
-
             return {
                 "success": False,
                 "output": None,
-                "error": error_msg
+                "error": cls._query_error()
             }
+        finally:
+            if connection is None:
+                databases.release(database, conn)
 
     @classmethod
-    def _connect_to_db(cls, database: str):
-        """Create database connection to northwind.db"""
-        try:
-            db_urls = {
-                "northwind": "https://github.com/nauqh/csautograde/blob/master/northwind.db?raw=true",
-                "chinook": "https://github.com/nauqh/cspyclient/blob/master/db/chinook.db?raw=true"
-            }
-
-            if database in db_urls:
-                response = requests.get(db_urls[database])
-                with open(database, "wb") as file:
-                    file.write(response.content)
-                return sqlite3.connect(database)
-            return None
-        except Exception:
-            cls.printt("Database connection error")
-            return None
+    def stream_query(cls, query: str, database: str, batch_size: int = 500):
+        """
+        Execute SQL query and yield the result as NDJSON: a line with the column
+        names, one JSON array per row, then a line with the row count (or the error).
+        Rows are fetched in batches, so memory stays bounded by `batch_size`.
+        """
+        if database not in databases.DATABASES:
+            yield dumps({"error": "Could not establish database connection"}) + b"\n"
+            return
+
+        rows_sent = 0
+        with databases.connection(database, PRACTICE) as conn:
+            try:
+                cur = conn.execute(query)
+                columns = [column[0] for column in cur.description or []]
+                yield dumps({"columns": columns}) + b"\n"
+                while rows := cur.fetchmany(batch_size):
+                    rows_sent += len(rows)
+                    yield b"".join(dumps(row) + b"\n" for row in rows)
+                cur.close()
+            except Exception:
+                yield dumps({"error": cls._query_error()}) + b"\n"
+                return
+        yield dumps({"rows": rows_sent}) + b"\n"
 
     @classmethod
     def serialize_value(cls, val):
-        if isinstance(val, (np.integer, np.int64)):
-            return int(val)
-        elif isinstance(val, (np.floating, np.float64)):
-            # Handle infinity and NaN values properly
-            if np.isnan(val) or np.isinf(val):
-                return None
-            return float(val)
-        elif isinstance(val, (np.bool_)):
-            return bool(val)
-        elif pd.isna(val):
-            return None
-        elif isinstance(val, np.ndarray):
-            return [cls.serialize_value(x) for x in val.tolist()]
-        elif isinstance(val, (pd.Period, pd.Timestamp)):
-            return str(val)
-        elif isinstance(val, (pd.Interval)):
-            return str(val)
-        elif isinstance(val, (datetime.date, datetime.datetime)):
-            return str(val)
-        elif isinstance(val, (tuple, list)):
-            return [cls.serialize_value(x) for x in val]
-        elif isinstance(val, dict):
-            return {str(k): cls.serialize_value(v) for k, v in val.items()}
-        elif isinstance(val, set):
-            return [cls.serialize_value(x) for x in list(val)]
-        elif isinstance(val, float):
-            # Handle Python native float infinity and NaN
-            if math.isnan(val) or math.isinf(val):
-                return None
-            return val
-        return val
+        return serialize_value(val)
@@ -1,8 +1,12 @@
 from fastapi import Depends
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, Session, declarative_base
 from typing import Annotated
 import os
+import threading
+import time
 
 from dotenv import load_dotenv
 
@@ -20,6 +24,89 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+# Async drivers for the sync URLs accepted in DB_CONNECTION
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+psycopg",
+    "postgresql+psycopg2": "postgresql+psycopg",
+    "sqlite": "sqlite+aiosqlite",
+}
+STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 15000))
+
+async_url = make_url(SQLALCHEMY_DATABASE_URL)
+async_url = async_url.set(
+    drivername=ASYNC_DRIVERS.get(async_url.drivername, async_url.drivername))
+
+# Used by the API handlers, so a slow query only suspends the request waiting for it
+async_engine = create_async_engine(
+    async_url,
+    pool_size=int(os.getenv("DB_POOL_SIZE", 5)),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)),
+    pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", 10)),  # Wait for a free connection
+    pool_recycle=1800,
+    pool_pre_ping=True,
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def _set_statement_timeout(dbapi_connection, connection_record):
+    """Abort statements running longer than DB_STATEMENT_TIMEOUT_MS"""
+    if async_engine.dialect.name == "postgresql" and STATEMENT_TIMEOUT_MS:
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"SET statement_timeout = {STATEMENT_TIMEOUT_MS}")
+        cursor.close()
+
+
+class PoolMetrics:
+    """Connection pool counters: checkouts, new connections and how long connections are held"""
+
+    def __init__(self, engine):
+        self.pool = engine.pool
+        self._lock = threading.Lock()
+        self._stats = {"checkouts": 0, "connects": 0, "invalidated": 0,
+                       "total_hold_ms": 0.0, "max_hold_ms": 0.0}
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+        event.listen(engine, "invalidate", self._on_invalidate)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self._stats["connects"] += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checked_out_at"] = time.perf_counter()
+        with self._lock:
+            self._stats["checkouts"] += 1
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        started = connection_record.info.pop("checked_out_at", None)
+        if started is None:
+            return
+        held_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self._stats["total_hold_ms"] += held_ms
+            self._stats["max_hold_ms"] = max(self._stats["max_hold_ms"], held_ms)
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self._stats["invalidated"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["avg_hold_ms"] = stats["total_hold_ms"] / stats["checkouts"] if stats["checkouts"] else 0.0
+        for name in ("size", "checkedout", "overflow"):
+            if hasattr(self.pool, name):
+                stats[name] = getattr(self.pool, name)()
+        return stats
+
+
+pool_metrics = {
+    "sync": PoolMetrics(engine),
+    "async": PoolMetrics(async_engine.sync_engine),
+}
+
 
 def get_db():
     db = SessionLocal()
@@ -29,4 +116,10 @@ def get_db():
         db.close()
 
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
 DbSession = Annotated[Session, Depends(get_db)]
+AsyncDbSession = Annotated[AsyncSession, Depends(get_async_db)]
@@ -0,0 +1,149 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from uuid import UUID
+
+from loguru import logger
+
+from .csautograde import Autograder
+from .database import SessionLocal
+from .schemas import Submission, SubmissionStatus
+from .websocket import manager
+from . import models
+
+
+def feedback_from_summary(summary: str) -> str:
+    """Remove the Issue section from an autograder report, keeping the FINAL SCORE"""
+    feedback = summary
+    issue_index = feedback.find("Issue:")
+    if issue_index != -1:
+        # Find the end of the Issue section (either the next section or end of text)
+        final_score_index = feedback.find("FINAL SCORE:")
+        if final_score_index != -1:
+            # Remove the Issue section but keep the FINAL SCORE
+            feedback = feedback[:issue_index] + feedback[final_score_index:]
+        else:
+            # If no FINAL SCORE section, just remove the Issue section to the end
+            feedback = feedback[:issue_index]
+    return feedback
+
+
+class GradingQueue:
+    """
+    Grades submissions in the background.
+
+    Submissions are stored with status `marking` by the API; the autograder then
+    runs on a small thread pool (student code itself goes to the sandbox pool),
+    the row is moved to `completed` or `failed`, and the result is pushed to the student over /ws.
+    While it runs, per-question progress is sent to the submitting user's /ws clients.
+    """
+
+    def __init__(self, workers: int = 4):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="grading")
+        self._tasks: set[asyncio.Task] = set()
+
+    def submit(self, submission_id: UUID, data: Submission):
+        """Schedule grading of a stored submission"""
+        task = asyncio.create_task(self._grade(submission_id, data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    def _run_autograder(data: Submission, on_progress=None):
+        ag = Autograder(data, on_progress=on_progress)
+        ag.grade_submission()
+        return ag.create_report()
+
+    @staticmethod
+    def _progress_sender(loop: asyncio.AbstractEventLoop, submission_id: UUID, data: Submission):
+        """Autograder progress callback, called from a grading thread"""
+        def send(event: dict):
+            asyncio.run_coroutine_threadsafe(manager.send_to(data.email, {
+                "type": "grading_progress",
+                "content": {
+                    "submission_id": str(submission_id),
+                    "exam_id": data.exam_id,
+                    **event,
+                }
+            }), loop)
+        return send
+
+    @staticmethod
+    def _store_result(submission_id: UUID, status: SubmissionStatus, summary: str, score):
+        with SessionLocal() as db:
+            submission = db.get(models.Submission, submission_id)
+            if submission is None:
+                logger.warning(f"Graded submission {submission_id} no longer exists")
+                return
+            submission.summary = summary
+            submission.feedback = feedback_from_summary(summary)
+            submission.score = score
+            submission.status = status.value
+            db.commit()
+
+    async def _grade(self, submission_id: UUID, data: Submission):
+        loop = asyncio.get_running_loop()
+        try:
+            summary, score = await loop.run_in_executor(
+                self._executor, self._run_autograder, data,
+                self._progress_sender(loop, submission_id, data))
+            status = SubmissionStatus.COMPLETED
+        except Exception as e:
+            logger.error(f"Error grading submission {submission_id}: {e}")
+            summary, score = f"Autograding failed: {e}\n", None
+            status = SubmissionStatus.FAILED
+
+        try:
+            await loop.run_in_executor(
+                self._executor, self._store_result, submission_id, status, summary, score)
+        except Exception as e:
+            logger.error(f"Error saving grade for submission {submission_id}: {e}")
+            return
+
+        logger.info(f"Submission {submission_id} graded: {status.value}")
+        try:
+            # The grade only goes to the student's own clients
+            await manager.send_to(data.email, {
+                "type": "submission_graded",
+                "content": {
+                    "submission_id": str(submission_id),
+                    "email": data.email,
+                    "exam_id": data.exam_id,
+                    "status": status.value,
+                    "score": score,
+                }
+            })
+            # Everyone else (e.g. staff dashboards) only learns that the exam has a new grade
+            await manager.broadcast({
+                "type": "submissions_updated",
+                "content": {"exam_id": data.exam_id, "status": status.value},
+            })
+        except Exception as e:
+            logger.error(f"Failed to push grade for submission {submission_id}: {e}")
+
+    async def resume(self):
+        """Re-queue submissions left in `marking` by a previous process"""
+        def pending():
+            with SessionLocal() as db:
+                return db.query(models.Submission).filter(
+                    models.Submission.status == SubmissionStatus.MARKING.value
+                ).all()
+
+        loop = asyncio.get_running_loop()
+        for submission in await loop.run_in_executor(self._executor, pending):
+            self.submit(submission.id, Submission(
+                email=submission.email,
+                answers=submission.answers,
+                exam_id=submission.exam_id,
+                exam_name=submission.exam_name,
+            ))
+
+    async def shutdown(self):
+        for task in list(self._tasks):
+            task.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+grading = GradingQueue(workers=int(os.getenv("GRADING_WORKERS", 4)))
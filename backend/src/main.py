@@ -1,22 +1,55 @@
-from fastapi import FastAPI, status, HTTPException, WebSocket
+from fastapi import FastAPI, status, HTTPException, WebSocket, Response, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
+import asyncio
 from .schemas import CodeExecution, Language, HelpRequest
 from .csautograde.utils import Utils
+from .csautograde import serializer
+from .csautograde.result_store import results
+from .csautograde import Autograder
+from .csautograde.autograder import execute_dataframe_expression
 from .websocket import manager
+from .grading import grading
+from .notifications import outbox
 from .csautograde.resource_manager import ResourceManager
+from .csautograde.sandbox import sandbox, SandboxError
+from .csautograde.s3 import s3
+from .csautograde.databases import databases
 from . import models
-from .database import engine
+from .migrations import run_migrations
+from .database import engine, async_engine, pool_metrics
 # Routers
 from .routers import exams, submissions
-import pandas as pd
-import numpy as np
+from typing import Optional
 
 models.Base.metadata.create_all(bind=engine)
+run_migrations(engine)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm the solution cache for every exam with one batch of concurrent fetches
+    asyncio.get_running_loop().run_in_executor(
+        None, ResourceManager.prefetch, [f"solutions/{exam_id}.yml" for exam_id in exams.EXAMS])
+    await grading.resume()
+    outbox.start()
+    manager.start()
+    yield
+    await grading.shutdown()
+    await outbox.shutdown()
+    await manager.shutdown()
+    sandbox.shutdown()
+    s3.shutdown()
+    await async_engine.dispose()
+
 
 app = FastAPI(
     title="CS Exam Python Client",
     summary="Client for Attempting and Submitting Exams",
     version="2.0.0",
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -25,6 +58,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
 app.include_router(exams.router)
@@ -32,11 +66,13 @@ app.include_router(submissions.router)
 
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, user: Optional[str] = None):
+    """Broadcast messages; with `?user=<email>` also that user's grading progress"""
+    await manager.connect(websocket, user)
     try:
         while True:
             await websocket.receive_text()
+            manager.touch(websocket)
     except Exception:
         manager.disconnect(websocket)
 
@@ -46,6 +82,23 @@ def root():
     return {"message": "Root endpoint"}
 
 
+@app.get("/metrics")
+async def metrics():
+    """In-process cache and runtime counters for this worker"""
+    return {
+        "resources": ResourceManager.cache_stats(),
+        "expected_results": Autograder.cache_stats(),
+        "result_store": results.stats(),
+        "exams": exams.cache_stats(),
+        "s3": s3.stats(),
+        "database": {name: metrics.stats() for name, metrics in pool_metrics.items()},
+        "notifications": await outbox.stats(),
+        "websocket": manager.stats(),
+        "sandbox": sandbox.stats(),
+        "sqlite": databases.stats(),
+    }
+
+
 @app.post("/execute")
 async def execute_code(data: CodeExecution):
     """
@@ -58,27 +111,37 @@ async def execute_code(data: CodeExecution):
         Dict containing execution output or error message
     """
     if data.language == Language.PYTHON:
-        clean_globals = {}
-        result = Utils.execute_code(data.code, clean_globals)
+        try:
+            result = await sandbox.arun(Utils.execute_code, data.code, {})
+        except SandboxError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(e)
+            )
     elif data.language == Language.PANDAS:
         # Load the exam configuration to get dataframe settings
         try:
-            solution = ResourceManager._get_s3_data("solutions/M31.yml")
-            resource_manager = ResourceManager(solution.get('config', {}))
-
-            # Execute the pandas expression
-            result = Utils.execute_expression(data.code, {
-                'df': resource_manager.get_resource('dataframe'),
-                'pd': pd,
-                'np': np
-            })
+            solution = await run_in_threadpool(ResourceManager._get_s3_data, "solutions/M31.yml")
+            config = solution.get('config', {}).get('resources', {}).get('dataframe')
+
+            # Execute the pandas expression in a sandbox worker, under its budget
+            result = await sandbox.arun(
+                execute_dataframe_expression, config, data.code, data.page_size)
+            if "result" in result:
+                result["handle"] = results.put(data.user_id, result.pop("result"))
+        except SandboxError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(e)
+            )
         except Exception as e:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=f"Error loading dataframe: {str(e)}"
             )
     else:
-        result = Utils.execute_query(data.code, data.database)
+        result = await run_in_threadpool(
+            Utils.execute_query, data.code, data.database, None, data.page_size, data.cursor)
 
     if not result["success"]:
         raise HTTPException(
@@ -86,10 +149,90 @@ async def execute_code(data: CodeExecution):
             detail=result["error"]
         )
 
-    return {
+    response = {
         "output": result["output"],
         "language": data.language
     }
+    if data.language == Language.SQL:
+        response.update({
+            "columns": result["columns"],
+            "total_rows_estimate": result["total_rows_estimate"],
+            "cursor": result["cursor"],
+        })
+    elif "handle" in result:
+        response.update({
+            "handle": result["handle"],
+            "total_rows": result["total_rows"],
+        })
+
+    # Results can be large; encode them straight to bytes
+    return Response(
+        content=serializer.dumps(response),
+        media_type="application/json",
+    )
+
+
+@app.get("/execute/results/{handle}")
+def get_result_page(
+    handle: str,
+    user_id: Optional[str] = None,
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=1000, ge=1, le=10000),
+    sort_by: Optional[str] = None,
+    ascending: bool = True,
+    columns: Optional[list[str]] = Query(default=None),
+):
+    """
+    Page through a stored pandas result without re-running the expression
+
+    Args:
+        handle: Handle returned by /execute for a result longer than one page
+        user_id: The user_id the result was created with
+        offset, limit: Rows to return
+        sort_by: Column to sort by (any value sorts a Series by its values)
+        ascending: Sort direction
+        columns: Only return these columns
+    """
+    entry = results.get(user_id, handle)
+    if entry is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Result not found or expired, run the expression again"
+        )
+    try:
+        page = results.page(entry, offset, limit, sort_by, ascending, columns)
+    except (KeyError, ValueError, TypeError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+
+    return Response(
+        content=serializer.dumps({
+            "output": serializer.serialize_result(page),
+            "handle": handle,
+            "offset": offset,
+            "total_rows": len(entry.value),
+        }),
+        media_type="application/json",
+    )
+
+
+@app.post("/execute/stream")
+def stream_query(data: CodeExecution):
+    """
+    Execute a SQL query and stream its result as NDJSON: a `{"columns": [...]}`
+    line, one JSON array per row, then `{"rows": n}` (or `{"error": ...}`)
+    """
+    if data.language != Language.SQL:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Only SQL results can be streamed"
+        )
+    return StreamingResponse(
+        Utils.stream_query(data.code, data.database),
+        media_type="application/x-ndjson",
+    )
 
 
 @app.post("/help", status_code=status.HTTP_200_OK)
@@ -0,0 +1,43 @@
+"""
+Schema changes for databases created before the current models.
+
+`Base.metadata.create_all` only creates missing tables, so indexes added to
+an existing table are created here. Every step is idempotent; on PostgreSQL
+indexes are built CONCURRENTLY so the table stays writable meanwhile.
+
+    python -m src.migrations
+"""
+from loguru import logger
+from sqlalchemy import Engine
+
+from .database import engine as default_engine
+from . import models
+
+
+def _create_indexes(connection, table):
+    for index in sorted(table.indexes, key=lambda index: index.name):
+        if connection.dialect.name == "postgresql":
+            index.dialect_options["postgresql"]["concurrently"] = True
+        index.create(connection, checkfirst=True)
+
+
+MIGRATIONS = [
+    ("submission read indexes", lambda connection: _create_indexes(
+        connection, models.Submission.__table__)),
+]
+
+
+def run_migrations(engine: Engine = default_engine):
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for name, migrate in MIGRATIONS:
+            try:
+                migrate(connection)
+            except Exception as e:
+                logger.error(f"Migration '{name}' failed: {e}")
+                raise
+            logger.info(f"Migration '{name}' applied")
+
+
+if __name__ == "__main__":
+    run_migrations()
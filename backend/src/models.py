@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, JSON
+from sqlalchemy import Column, Integer, String, DateTime, JSON, Index
 from sqlalchemy.dialects.postgresql import UUID
 import uuid
 from datetime import datetime, timezone
@@ -22,3 +22,43 @@ class Submission(Base):
 
     def __repr__(self):
         return f"<Submission(email='{self.email}', exam_id='{self.exam_id}', submitted_at={self.submitted_at})>"
+
+
+# Read paths of the submissions API; created on existing databases by src/migrations.py
+# Latest submission of a student for one exam
+Index("ix_submissions_email_exam_submitted_at",
+      Submission.email, Submission.exam_id, Submission.submitted_at.desc())
+# All submissions of a student, newest first
+Index("ix_submissions_email_submitted_at",
+      Submission.email, Submission.submitted_at.desc(), Submission.id.desc())
+# Marking queue: ungraded submissions, oldest first
+Index("ix_submissions_ungraded",
+      Submission.submitted_at, Submission.id,
+      postgresql_where=Submission.score.is_(None),
+      sqlite_where=Submission.score.is_(None))
+
+
+class Notification(Base):
+    """A webhook message waiting in the outbox, delivered by src/notifications.py"""
+    __tablename__ = "notifications"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    content = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="pending")  # pending, sent or failed
+    attempts = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False,
+                        default=lambda: datetime.now(timezone.utc))
+    next_attempt_at = Column(DateTime, nullable=False,
+                             default=lambda: datetime.now(timezone.utc))
+    sent_at = Column(DateTime)
+    last_error = Column(String)
+
+    def __repr__(self):
+        return f"<Notification(id={self.id}, status='{self.status}', attempts={self.attempts})>"
+
+
+# Due messages of the outbox dispatcher
+Index("ix_notifications_pending",
+      Notification.next_attempt_at, Notification.id,
+      postgresql_where=Notification.status == "pending",
+      sqlite_where=Notification.status == "pending")
@@ -0,0 +1,251 @@
+import asyncio
+import os
+import random
+import threading
+from datetime import datetime, timedelta, timezone
+
+import httpx
+from loguru import logger
+from sqlalchemy import func, select, update
+
+from .database import AsyncSessionLocal
+from . import models
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PENDING, SENT, FAILED = "pending", "sent", "failed"
+
+# Discord rejects messages longer than this
+MAX_MESSAGE_CHARS = 2000
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class WebhookOutbox:
+    """
+    Delivers webhook notifications written to the `notifications` table.
+
+    API handlers only add a `Notification` row in the same transaction as the
+    data it announces and call `wake()`. A background dispatcher then claims
+    due rows, joins them into as few messages as fit in one webhook post
+    (bursts of submissions become one message), and posts them over one
+    pooled HTTP client. Failed posts are retried with exponential backoff;
+    429 responses are retried after the delay the server asks for.
+
+    Rows are claimed with a short lease, so several processes can share the
+    table without sending a message twice while the lease holds. Point `url`
+    at a local server (or pass an `httpx.AsyncClient` with a mock transport)
+    for testing; without a `url` messages are kept in the table until one is set.
+    """
+
+    def __init__(self, url: str = None, batch_size: int = 20, batch_window: float = 1.0,
+                 poll_interval: float = 30, max_attempts: int = 8, backoff: float = 2,
+                 max_backoff: float = 600, lease: float = 60, client: httpx.AsyncClient = None):
+        self.url = url
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+        self._client = client
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task = None
+        self._lock = threading.Lock()
+        self._stats = {"posts": 0, "sent": 0, "retries": 0, "rate_limited": 0, "failed": 0}
+
+    def _count(self, name: str, n: int = 1):
+        with self._lock:
+            self._stats[name] += n
+
+    def start(self):
+        if not self.url:
+            logger.warning("No webhook URL configured; notifications stay in the outbox")
+            return
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(10.0),
+                limits=httpx.Limits(max_connections=4, max_keepalive_connections=2),
+            )
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def wake(self):
+        """Deliver pending messages soon instead of at the next poll"""
+        self._wake.set()
+
+    async def _run(self):
+        delay = 0
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+                # Let a burst of submissions land before sending
+                await asyncio.sleep(self.batch_window)
+            except TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                delay = await self.dispatch()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Webhook dispatch failed: {e}")
+                delay = self.poll_interval
+
+    async def _claim(self) -> list[models.Notification]:
+        """Lease the due messages so no other dispatcher picks them up meanwhile"""
+        now = _now()
+        async with AsyncSessionLocal() as db:
+            notifications = (await db.scalars(
+                select(models.Notification).where(
+                    models.Notification.status == PENDING,
+                    models.Notification.next_attempt_at <= now,
+                ).order_by(models.Notification.next_attempt_at, models.Notification.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            )).all()
+            for notification in notifications:
+                notification.next_attempt_at = now + timedelta(seconds=self.lease)
+            await db.commit()
+        return notifications
+
+    async def _next_due(self) -> float:
+        """Seconds until the next pending message is due, capped at the poll interval"""
+        async with AsyncSessionLocal() as db:
+            due = await db.scalar(
+                select(models.Notification.next_attempt_at)
+                .where(models.Notification.status == PENDING)
+                .order_by(models.Notification.next_attempt_at).limit(1))
+        if due is None:
+            return self.poll_interval
+        if due.tzinfo is None:
+            due = due.replace(tzinfo=timezone.utc)
+        return min(max((due - _now()).total_seconds(), 0), self.poll_interval)
+
+    @staticmethod
+    def _batches(notifications: list[models.Notification]) -> list[list[models.Notification]]:
+        """Group messages, in order, into posts of at most MAX_MESSAGE_CHARS"""
+        batches, size = [], 0
+        for notification in notifications:
+            length = len(notification.content) + 1
+            if not batches or size + length > MAX_MESSAGE_CHARS:
+                batches.append([])
+                size = 0
+            batches[-1].append(notification)
+            size += length
+        return batches
+
+    def _retry_delay(self, attempts: int) -> float:
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        return delay * random.uniform(0.5, 1.0)
+
+    @staticmethod
+    def _retry_after(response: httpx.Response):
+        """Delay asked for by a 429 response, from Retry-After or Discord's JSON body"""
+        try:
+            return float(response.headers["retry-after"])
+        except (KeyError, ValueError):
+            pass
+        try:
+            return float(response.json()["retry_after"])
+        except Exception:
+            return None
+
+    async def _post(self, content: str):
+        """POST one message; returns (delivered, retry_delay, error)"""
+        self._count("posts")
+        try:
+            response = await self._client.post(self.url, json={"content": content, "flags": 4})
+        except httpx.HTTPError as e:
+            return False, None, f"{type(e).__name__}: {e}"
+        if response.is_success:
+            return True, None, None
+        error = f"HTTP {response.status_code}: {response.text[:200]}"
+        if response.status_code == 429:
+            self._count("rate_limited")
+            return False, self._retry_after(response), error
+        if response.status_code >= 500:
+            return False, None, error
+        # Other client errors will not succeed on retry
+        return False, float("inf"), error
+
+    async def _record(self, batch: list[models.Notification], delivered: bool,
+                      retry_delay, error: str):
+        now = _now()
+        ids = [notification.id for notification in batch]
+        async with AsyncSessionLocal() as db:
+            if delivered:
+                await db.execute(update(models.Notification).where(
+                    models.Notification.id.in_(ids)
+                ).values(status=SENT, sent_at=now, attempts=models.Notification.attempts + 1))
+                self._count("sent", len(batch))
+            else:
+                for notification in batch:
+                    attempts = notification.attempts + 1
+                    values = {"attempts": attempts, "last_error": error}
+                    if retry_delay == float("inf") or attempts >= self.max_attempts:
+                        values["status"] = FAILED
+                        self._count("failed")
+                        logger.error(f"Giving up on notification {notification.id}: {error}")
+                    else:
+                        delay = retry_delay if retry_delay is not None else self._retry_delay(attempts)
+                        values["next_attempt_at"] = now + timedelta(seconds=delay)
+                        self._count("retries")
+                    await db.execute(update(models.Notification).where(
+                        models.Notification.id == notification.id).values(**values))
+            await db.commit()
+
+    async def dispatch(self) -> float:
+        """Send every due message; returns the seconds until the next one is due"""
+        while notifications := await self._claim():
+            batches = self._batches(notifications)
+            for i, batch in enumerate(batches):
+                delivered, retry_delay, error = await self._post(
+                    "\n".join(notification.content for notification in batch))
+                if retry_delay is not None and retry_delay != float("inf"):
+                    # Rate limited: the remaining batches wait as long as this one
+                    for rest in batches[i:]:
+                        await self._record(rest, False, retry_delay, error)
+                    return await self._next_due()
+                await self._record(batch, delivered, retry_delay, error)
+                if not delivered:
+                    logger.warning(f"Webhook post failed: {error}")
+        return await self._next_due()
+
+    async def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        try:
+            async with AsyncSessionLocal() as db:
+                stats["pending"] = await db.scalar(
+                    select(func.count()).select_from(models.Notification)
+                    .where(models.Notification.status == PENDING))
+        except Exception:
+            stats["pending"] = None
+        stats["enabled"] = bool(self.url)
+        return stats
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+outbox = WebhookOutbox(
+    url=os.getenv("DISCORD_WEBHOOK_URL") or None,
+    batch_size=int(os.getenv("WEBHOOK_BATCH_SIZE", 20)),
+    batch_window=float(os.getenv("WEBHOOK_BATCH_WINDOW", 1.0)),
+    max_attempts=int(os.getenv("WEBHOOK_MAX_ATTEMPTS", 8)),
+)
@@ -0,0 +1,201 @@
+"""
+Re-grade every submission of an exam after its solution file changed.
+
+    python -m src.regrade M21 --dry-run
+    python -m src.regrade M21 --workers 8 --batch-size 500
+
+Submissions whose feedback a marker has edited keep their feedback and
+score; only their autograder report (`summary`) is refreshed.
+"""
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+from loguru import logger
+from sqlalchemy import func, select, tuple_, update
+
+from .csautograde import Autograder
+from .csautograde.resource_manager import ResourceManager
+from .csautograde.sandbox import sandbox
+from .database import SessionLocal
+from .grading import feedback_from_summary
+from .schemas import SubmissionStatus
+from . import models
+
+# Loaded once per worker process and shared by every submission it grades
+_solution = None
+_resource_manager = None
+
+
+def _init_worker(exam_id: str):
+    global _solution, _resource_manager
+    # The worker is already a separate process, so student code runs inline
+    sandbox.workers = 0
+    _solution = ResourceManager._get_s3_data(f"solutions/{exam_id}.yml")
+    if _solution is None:
+        raise RuntimeError(f"Solution for exam {exam_id} could not be loaded")
+    _resource_manager = ResourceManager(_solution.get('config', {}))
+
+
+def _grade_one(row: dict):
+    ag = Autograder(
+        SimpleNamespace(
+            exam_id=row["exam_id"], exam_name=row["exam_name"], answers=row["answers"]),
+        solution=_solution,
+        resource_manager=_resource_manager,
+    )
+    ag.grade_submission()
+    summary, score = ag.create_report()
+    return row["id"], summary, score
+
+
+def _batches(exam_id: str, batch_size: int, limit: int = None):
+    """
+    Stream the submissions of an exam in keyset-paginated batches, so no
+    cursor or transaction stays open while a batch is graded and written.
+    With `limit`, stop after the first `limit` submissions.
+    """
+    columns = (
+        models.Submission.id,
+        models.Submission.email,
+        models.Submission.exam_id,
+        models.Submission.exam_name,
+        models.Submission.answers,
+        models.Submission.score,
+        models.Submission.summary,
+        models.Submission.feedback,
+        models.Submission.submitted_at,
+    )
+    last = None
+    while limit is None or limit > 0:
+        if limit is not None:
+            batch_size = min(batch_size, limit)
+            limit -= batch_size
+        query = select(*columns).where(models.Submission.exam_id == exam_id)
+        if last is not None:
+            query = query.where(
+                tuple_(models.Submission.submitted_at, models.Submission.id) > last)
+        query = query.order_by(
+            models.Submission.submitted_at, models.Submission.id).limit(batch_size)
+
+        with SessionLocal() as db:
+            batch = [dict(row) for row in db.execute(query).mappings()]
+        if not batch:
+            return
+        last = (batch[-1]["submitted_at"], batch[-1]["id"])
+        yield batch
+        if len(batch) < batch_size:
+            return
+
+
+def _edited(row: dict) -> bool:
+    """Whether a marker changed the feedback the autograder wrote"""
+    return row["feedback"] != feedback_from_summary(row["summary"])
+
+
+def regrade_exam(exam_id: str, dry_run: bool = False, workers: int = None, batch_size: int = 200,
+                 limit: int = None) -> dict:
+    """
+    Re-grade all submissions of `exam_id` (the first `limit` with `limit`)
+    and write the new scores back.
+
+    Returns a report with the number of submissions processed and the score
+    changes; with `dry_run` nothing is written. Hand-edited submissions are
+    listed under `edited` with their new autograder score instead, and only
+    their summary is updated.
+    """
+    # Make sure the corrected solution is picked up, here and in new submissions
+    ResourceManager._s3_cache.invalidate(f"solutions/{exam_id}.yml")
+
+    with SessionLocal() as db:
+        total = db.scalar(
+            select(func.count()).select_from(models.Submission)
+            .where(models.Submission.exam_id == exam_id)
+        )
+    logger.info(f"Re-grading {total} submissions of {exam_id}"
+                f"{' (dry run)' if dry_run else ''}")
+
+    report = {"exam_id": exam_id, "dry_run": dry_run, "total": total,
+              "processed": 0, "changed": 0, "changes": [], "edited": []}
+    if not total:
+        return report
+
+    workers = workers or os.cpu_count() or 1
+    started = time.monotonic()
+    ctx = multiprocessing.get_context("forkserver")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                             initializer=_init_worker, initargs=(exam_id,)) as executor:
+        for batch in _batches(exam_id, batch_size, limit):
+            rows = {row["id"]: row for row in batch}
+            results = executor.map(
+                _grade_one, batch, chunksize=max(1, len(batch) // (workers * 4)))
+
+            updates = []
+            for submission_id, summary, score in results:
+                row = rows[submission_id]
+                if _edited(row):
+                    # Keep the marker's feedback and score; they can review the new report
+                    report["edited"].append({
+                        "submission_id": str(submission_id),
+                        "score": row["score"],
+                        "autograde_score": score,
+                    })
+                    updates.append({"id": submission_id, "summary": summary})
+                    continue
+                if row["score"] != score:
+                    report["changed"] += 1
+                    report["changes"].append({
+                        "submission_id": str(submission_id),
+                        "old_score": row["score"],
+                        "new_score": score,
+                    })
+                updates.append({
+                    "id": submission_id,
+                    "summary": summary,
+                    "feedback": feedback_from_summary(summary),
+                    "score": score,
+                    "status": SubmissionStatus.COMPLETED.value,
+                })
+
+            if not dry_run:
+                with SessionLocal() as db:
+                    db.execute(update(models.Submission), updates)
+                    db.commit()
+
+            report["processed"] += len(batch)
+            elapsed = time.monotonic() - started
+            logger.info(f"{exam_id}: {report['processed']}/{total} re-graded, "
+                        f"{report['changed']} changed ({report['processed'] / elapsed:.1f}/s)")
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("exam_id", help="Exam to re-grade, e.g. M21")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Report score changes without writing them")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of grading processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=200,
+                        help="Submissions fetched and written per batch")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="Only re-grade the first LIMIT submissions")
+    args = parser.parse_args()
+
+    report = regrade_exam(args.exam_id, args.dry_run, args.workers, args.batch_size, args.limit)
+    for change in report["changes"]:
+        print(f"{change['submission_id']}: {change['old_score']} -> {change['new_score']}")
+    for edited in report["edited"]:
+        print(f"{edited['submission_id']}: hand-edited, kept {edited['score']} "
+              f"(autograder now gives {edited['autograde_score']})")
+    print(f"{report['processed']}/{report['total']} submissions re-graded, "
+          f"{report['changed']} score changes{' (dry run, nothing written)' if args.dry_run else ''}")
+
+
+if __name__ == "__main__":
+    main()
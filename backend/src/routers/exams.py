@@ -1,53 +1,120 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request, Response, status
+from fastapi.concurrency import run_in_threadpool
+from dataclasses import dataclass
 from ..schemas import Exam
-import boto3
-import json
+from ..csautograde.cache import TTLCache, NOT_MODIFIED
+from ..csautograde.s3 import s3, S3NotFound
+import gzip
+import hashlib
+import orjson
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 router = APIRouter(prefix="/exams", tags=["Exams"])
 
+EXAMS = {
+    "M11": "Basic SQL",
+    "M12": "Advanced SQL",
+    "M21": "Python 101",
+    "M31": "Pandas 101",
+}
+
+EXAM_CACHE_TTL = int(os.getenv("EXAM_CACHE_TTL", 60))
+
+
+class ExamNotFound(Exception):
+    pass
+
+
+@dataclass
+class ExamContent:
+    """A serialized exam response, ready to send in every supported encoding"""
+    etag: str
+    bodies: dict[str, bytes]
+
 
-def exam_exists(exam_id):
-    s3 = boto3.client("s3")
+_exams = TTLCache("exams", ttl=EXAM_CACHE_TTL, maxsize=int(os.getenv("EXAM_CACHE_SIZE", 32)))
+
+
+def _load_exam(exam_id: str, s3_etag: str | None):
+    """Fetch an exam from S3 (conditionally on `s3_etag`) and pre-build its response bodies"""
     try:
-        s3.head_object(Bucket="csexam", Key=f"exams/{exam_id}.json")
-        return True
-    except s3.exceptions.NoSuchKey:
-        return False
-    except Exception as e:
-        raise HTTPException(
-            status_code=500, detail=f"Error checking exam {exam_id}: {str(e)}"
-        )
+        obj = s3.get("csexam", f"exams/{exam_id}.json", s3_etag)
+    except S3NotFound:
+        raise ExamNotFound(exam_id)
+    if obj is NOT_MODIFIED:
+        return NOT_MODIFIED
+
+    raw = obj.body
+    # Validate once per version; the stored JSON is embedded as is
+    if not isinstance(orjson.loads(raw), list):
+        raise ValueError(f"Exam {exam_id} is not a list of questions")
+
+    body = (b'{"id":' + orjson.dumps(exam_id) + b',"name":'
+            + orjson.dumps(EXAMS.get(exam_id, "N.A.")) + b',"data":' + raw.strip() + b'}')
+    bodies = {"identity": body, "gzip": gzip.compress(body, mtime=0)}
+    if brotli is not None:
+        bodies["br"] = brotli.compress(body)
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    return ExamContent(etag, bodies), obj.etag
+
+
+def get_exam_content(exam_id: str) -> ExamContent:
+    """Cached exam content; concurrent requests for the same exam share one S3 call"""
+    return _exams.get(exam_id, lambda s3_etag: _load_exam(exam_id, s3_etag))
+
+
+def _accepted_encoding(accept_encoding: str, bodies: dict) -> str:
+    accepted = {part.split(";")[0].strip() for part in accept_encoding.lower().split(",")}
+    for encoding in ("br", "gzip"):
+        if encoding in accepted and encoding in bodies:
+            return encoding
+    return "identity"
 
 
 @router.get("/{id}", response_model=Exam)
-async def get_exam(id: str):
+async def get_exam(id: str, request: Request):
     """
     Retrieves a single exam from the database by its id.
 
+    The response carries an ETag; send it back in `If-None-Match` to get a
+    304 when the exam has not changed.
+
     Returns:
         Exam: The exam if found.
     """
-    s3 = boto3.client("s3")
-    bucket_name = "csexam"
-    file_name = f"exams/{id}.json"
-
-    if not exam_exists(id):
-        raise HTTPException(status_code=404, detail=f"Exam {id} not found")
-
     try:
-        obj = s3.get_object(Bucket=bucket_name, Key=file_name)
-        data = obj["Body"].read().decode("utf-8")
+        content = await run_in_threadpool(get_exam_content, id)
+    except ExamNotFound:
+        raise HTTPException(status_code=404, detail=f"Exam {id} not found")
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Error retrieving exam {id}: {str(e)}"
         )
 
-    EXAMS = {
-        "M11": "Basic SQL",
-        "M12": "Advanced SQL",
-        "M21": "Python 101",
-        "M31": "Pandas 101",
+    headers = {
+        "ETag": content.etag,
+        "Cache-Control": f"public, max-age={EXAM_CACHE_TTL}",
+        "Vary": "Accept-Encoding",
     }
+    if_none_match = request.headers.get("if-none-match", "")
+    if content.etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    encoding = _accepted_encoding(request.headers.get("accept-encoding", ""), content.bodies)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(
+        content=content.bodies[encoding],
+        media_type="application/json",
+        headers=headers,
+    )
+
 
-    return {"id": id, "name": EXAMS.get(id, "N.A."), "data": json.loads(data)}
+def cache_stats() -> dict:
+    return _exams.stats()
@@ -1,105 +1,146 @@
-from fastapi import HTTPException, APIRouter, status
-from sqlalchemy.orm import Session
-from ..csautograde import Autograder
-from uuid import UUID
-import httpx
-
-from ..schemas import SubmissionResponse, Submission
-from ..database import DbSession
+from fastapi import HTTPException, APIRouter, status, BackgroundTasks, Query, Response
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import select, tuple_
+from sqlalchemy.orm import load_only
+from sqlalchemy.ext.asyncio import AsyncSession
+from pydantic import TypeAdapter
+from datetime import datetime
+from typing import Literal, Optional
+from uuid import UUID, uuid4
+import base64
+import json
+import os
+
+from ..schemas import SubmissionResponse, SubmissionBrief, Submission, SubmissionStatus
+from ..grading import grading
+from ..notifications import outbox
+from ..regrade import regrade_exam
+from ..database import AsyncDbSession
 from .. import models
-from .exams import exam_exists
 
 from loguru import logger
 
 router = APIRouter(prefix="/submissions", tags=["Submissions"])
 
+MARKING_URL = os.getenv("MARKING_URL", "https://csassessment.it.com/marking")
 
-def email_exist(email: str, db: Session):
-    """Validate email exists in database."""
-    email_exists = db.query(models.Submission).filter(
-        models.Submission.email == email).first()
-    if not email_exists:
+# Columns loaded for `fields=brief`; answers, summary and feedback are left in the table
+BRIEF_COLUMNS = (
+    models.Submission.id, models.Submission.email, models.Submission.exam_id,
+    models.Submission.exam_name, models.Submission.submitted_at,
+    models.Submission.score, models.Submission.status,
+)
+LISTING_MODELS = {
+    "full": TypeAdapter(list[SubmissionResponse]),
+    "brief": TypeAdapter(list[SubmissionBrief]),
+}
+
+
+def submission_notification(submission: models.Submission) -> str:
+    """Webhook message announcing a new submission to the markers"""
+    return (
+        f"### New submission from **`{submission.email}`**\n"
+        f"- **Exam:** {submission.exam_name}\n"
+        f"- **View:** [Open marking page]({MARKING_URL}/{submission.id})"
+    )
+
+
+def _encode_cursor(submission: models.Submission) -> str:
+    """Opaque keyset position just after `submission`"""
+    token = json.dumps({"t": submission.submitted_at.isoformat(), "i": submission.id.hex})
+    return base64.urlsafe_b64encode(token.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> tuple[datetime, UUID]:
+    try:
+        token = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(token["t"]), UUID(token["i"])
+    except Exception:
         raise HTTPException(
-            status_code=404, detail=f"Email {email} not found")
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+async def _list_page(db: AsyncSession, query, limit: int, cursor: Optional[str],
+                     fields: str, newest_first: bool = True) -> Response:
+    """
+    One page of `query`, keyset-paginated on (submitted_at, id).
+
+    The page is read with a range condition on the position in `cursor`, so
+    any page costs the same whatever the history size. The cursor of the next
+    page is returned in the `X-Next-Cursor` header when there are more rows.
+    """
+    position = tuple_(models.Submission.submitted_at, models.Submission.id)
+    if cursor:
+        after = tuple_(*_decode_cursor(cursor))
+        query = query.where(position < after if newest_first else position > after)
+    if newest_first:
+        query = query.order_by(models.Submission.submitted_at.desc(), models.Submission.id.desc())
+    else:
+        query = query.order_by(models.Submission.submitted_at, models.Submission.id)
+    if fields == "brief":
+        query = query.options(load_only(*BRIEF_COLUMNS))
+
+    submissions = (await db.scalars(query.limit(limit + 1))).all()
+    has_more = len(submissions) > limit
+    submissions = submissions[:limit]
+
+    for submission in submissions:
+        if submission.score is not None:
+            submission.status = "completed"
+
+    headers = {"X-Next-Cursor": _encode_cursor(submissions[-1])} if has_more else {}
+    return Response(
+        content=LISTING_MODELS[fields].dump_json(
+            LISTING_MODELS[fields].validate_python(submissions, from_attributes=True)),
+        media_type="application/json",
+        headers=headers,
+    )
 
 
 @router.post("", status_code=status.HTTP_201_CREATED)
-async def add_submission(data: Submission, db: DbSession):
+async def add_submission(data: Submission, db: AsyncDbSession):
     """
-    Add a new submission to the database.
+    Store a new submission and queue it for autograding.
+
+    The submission is saved with status `marking` and graded in the background;
+    the result is pushed over /ws and stored on the submission when done. The
+    markers' notification is queued in the outbox and sent after the response.
 
     Args:
         data: Submission data from the client
         db: Database session
 
     Returns:
-        A dictionary containing the summary and the submission_id
+        A dictionary containing the summary, the submission_id and the status
 
     Raises:
-        HTTPException: If autograding fails
+        HTTPException: If the submission cannot be saved
     """
     try:
-        # Run autograder on the submission
-        ag = Autograder(data)
-        ag.grade_submission()
-        summary, final_score = ag.create_report()
-
-        # Create submission record
-        submission = models.Submission(**data.model_dump())
-        submission.summary = summary
-        
-        # Remove the Issue section from feedback
-        feedback = summary
-        issue_index = feedback.find("Issue:")
-        if issue_index != -1:
-            # Find the end of the Issue section (either the next section or end of text)
-            final_score_index = feedback.find("FINAL SCORE:")
-            if final_score_index != -1:
-                # Remove the Issue section but keep the FINAL SCORE
-                feedback = feedback[:issue_index] + feedback[final_score_index:]
-            else:
-                # If no FINAL SCORE section, just remove the Issue section to the end
-                feedback = feedback[:issue_index]
-        
-        submission.feedback = feedback  # Initialize feedback without the Issue section
-        submission.score = final_score
-        submission.status = "completed"
-
-        # Save to database
+        # Create submission record, graded later by the background workers
+        submission = models.Submission(id=uuid4(), **data.model_dump())
+        submission.summary = ""
+        submission.feedback = ""
+        submission.score = None
+        submission.status = SubmissionStatus.MARKING.value
+
+        # Save to database, with the marker notification in the same transaction
         db.add(submission)
-        db.commit()
-        db.refresh(submission)
-
-        # Send notification to Discord webhook
-        webhook_url = "https://discord.com/api/webhooks/1357603401239760989/nFH8QB89_SloEgo26rVuRzE01mG_IkD4NVa8VAHb59palPfZiOr1ENewBM_Z6G_vVvds"
-
-        message_content = (
-            f"### New submission from **`{submission.email}`**\n"
-            f"- **Exam:** {submission.exam_name}\n"
-            f"- **View:** [Open marking page](https://csassessment.it.com/marking/{str(submission.id)})"
-        )
+        db.add(models.Notification(content=submission_notification(submission)))
+        await db.commit()
+        await db.refresh(submission)
 
-        discord_payload = {
-            "content": message_content,
-            "flags": 4
-        }
-
-        async with httpx.AsyncClient() as client:
-            try:
-                await client.post(webhook_url, json=discord_payload)
-                logger.info(
-                    f"Discord notification sent for submission {submission.id}")
-            except Exception as discord_err:
-                # Log error but don't fail the submission
-                logger.error(
-                    f"Failed to send Discord notification: {discord_err}")
+        grading.submit(submission.id, data)
+        outbox.wake()
 
         return {
-            "summary": summary,
-            "submission_id": str(submission.id)  # Convert UUID to string
+            "summary": submission.summary,
+            "submission_id": str(submission.id),  # Convert UUID to string
+            "status": submission.status
         }
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Error processing submission: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -107,20 +148,51 @@ async def add_submission(data: Submission, db: DbSession):
         )
 
 
+@router.post("/regrade/{exam_id}")
+async def regrade_submissions(exam_id: str, background_tasks: BackgroundTasks, dry_run: bool = True,
+                              workers: Optional[int] = None, sample: int = Query(50, ge=1, le=500)):
+    """Re-grade every submission of an exam against its current solution file.
+
+    Args:
+        exam_id: Exam to re-grade
+        dry_run: Only report the score changes (default), without writing them
+        workers: Number of grading processes
+        sample: Submissions graded by a dry run, which answers within the request;
+            the full dry run is `python -m src.regrade EXAM --dry-run`
+
+    Returns:
+        The re-grade report for a dry run; otherwise an acknowledgement, the
+        re-grade running in the background.
+    """
+    if dry_run:
+        return await run_in_threadpool(regrade_exam, exam_id, True, workers, limit=sample)
+
+    background_tasks.add_task(regrade_exam, exam_id, False, workers)
+    return JSONResponse(
+        status_code=status.HTTP_202_ACCEPTED,
+        content={"message": f"Re-grading of {exam_id} started"}
+    )
+
+
 @router.get("/{exam}/{email}", response_model=SubmissionResponse)
-async def get_submission(exam: str, email: str, db: DbSession):
-    """Get a submission by email and exam.
+async def get_submission(exam: str, email: str, db: AsyncDbSession):
+    """Get the latest submission by email and exam.
+
+    Answered by one lookup on the (email, exam_id, submitted_at) index.
 
     Returns:
         The submission.
     """
-    email_exist(email, db)
-    exam_exists(exam)
-
-    submission = db.query(models.Submission).filter(
+    submission = await db.scalar(select(models.Submission).where(
         models.Submission.email == email,
         models.Submission.exam_id == exam
-    ).order_by(models.Submission.submitted_at.desc()).first()
+    ).order_by(models.Submission.submitted_at.desc()).limit(1))
+
+    if not submission:
+        raise HTTPException(
+            status_code=404,
+            detail=f"No submission of exam {exam} found for {email}"
+        )
 
     if submission.score is not None:
         submission.status = "completed"
@@ -128,8 +200,29 @@ async def get_submission(exam: str, email: str, db: DbSession):
     return submission
 
 
+@router.get("/queue", response_model=list[SubmissionBrief])
+async def get_marking_queue(db: AsyncDbSession, exam_id: Optional[str] = None,
+                            limit: int = Query(50, ge=1, le=500), cursor: Optional[str] = None,
+                            fields: Literal["full", "brief"] = "brief"):
+    """List ungraded submissions, oldest first.
+
+    Args:
+        exam_id: Only list submissions of this exam
+        limit: Page size
+        cursor: `X-Next-Cursor` of the previous page
+        fields: `brief` (default) leaves out answers, summary and feedback
+
+    Returns:
+        A page of submissions; the next page's cursor is in `X-Next-Cursor`.
+    """
+    query = select(models.Submission).where(models.Submission.score.is_(None))
+    if exam_id:
+        query = query.where(models.Submission.exam_id == exam_id)
+    return await _list_page(db, query, limit, cursor, fields, newest_first=False)
+
+
 @router.get("/{submission_id}", response_model=SubmissionResponse)
-async def get_specific_submission(submission_id: UUID, db: DbSession):
+async def get_specific_submission(submission_id: UUID, db: AsyncDbSession):
     """Get a specific submission by exam ID, email, and submission ID.
 
     Args:
@@ -140,9 +233,7 @@ async def get_specific_submission(submission_id: UUID, db: DbSession):
         The specific submission.
     """
 
-    submission = db.query(models.Submission).filter(
-        models.Submission.id == submission_id
-    ).first()
+    submission = await db.get(models.Submission, submission_id)
 
     if not submission:
         raise HTTPException(
@@ -156,28 +247,40 @@ async def get_specific_submission(submission_id: UUID, db: DbSession):
     return submission
 
 
-@router.get("", response_model=list[SubmissionResponse])
-async def get_all_submissions(email: str, db: DbSession):
-    """Get all submissions by email
+@router.get("", response_model=list[SubmissionResponse | SubmissionBrief])
+async def get_all_submissions(email: str, db: AsyncDbSession, exam_id: Optional[str] = None,
+                              submission_status: Optional[SubmissionStatus] = Query(None, alias="status"),
+                              limit: int = Query(100, ge=1, le=500), cursor: Optional[str] = None,
+                              fields: Literal["full", "brief"] = "full"):
+    """Get the submissions of an email, newest first
 
     Args:
         email: Email address as query parameter
+        exam_id: Only list submissions of this exam
+        status: Only list submissions with this stored status
+        limit: Page size
+        cursor: `X-Next-Cursor` of the previous page
+        fields: `brief` leaves out answers, summary and feedback
         db: Database session
 
     Returns:
-        The submission.
+        A page of submissions; the next page's cursor is in `X-Next-Cursor`.
     """
-    email_exist(email, db)
-
-    submissions = db.query(models.Submission).filter(
-        models.Submission.email == email,
-    ).order_by(models.Submission.submitted_at.desc()).all()
-
-    return submissions
+    query = select(models.Submission).where(models.Submission.email == email)
+    if exam_id:
+        query = query.where(models.Submission.exam_id == exam_id)
+    if submission_status:
+        query = query.where(models.Submission.status == submission_status.value)
+
+    response = await _list_page(db, query, limit, cursor, fields)
+    if not cursor and response.body == b"[]":
+        raise HTTPException(
+            status_code=404, detail=f"No submissions found for {email}")
+    return response
 
 
 @router.put("/{submission_id}/feedback", status_code=status.HTTP_200_OK)
-async def add_submission_feedback(submission_id: UUID, feedback: dict, db: DbSession):
+async def add_submission_feedback(submission_id: UUID, feedback: dict, db: AsyncDbSession):
     """Add feedback to a specific submission and update the score.
 
     This endpoint stores the provided feedback text and parses the 'FINAL SCORE' 
@@ -195,9 +298,7 @@ async def add_submission_feedback(submission_id: UUID, feedback: dict, db: DbSes
         HTTPException 404: If submission with given ID is not found
         HTTPException 422: If the score cannot be parsed from the feedback text
     """
-    submission = db.query(models.Submission).filter(
-        models.Submission.id == submission_id
-    ).first()
+    submission = await db.get(models.Submission, submission_id)
 
     if not submission:
         raise HTTPException(
@@ -224,8 +325,7 @@ async def add_submission_feedback(submission_id: UUID, feedback: dict, db: DbSes
             )
 
     # Save changes to database
-    db.commit()
-    db.refresh(submission)
+    await db.commit()
 
     # If you want to notify over websocket about the feedback, uncomment and adjust
     # notification = {
@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime
 from typing import Optional, Literal
 from enum import Enum
@@ -28,7 +28,18 @@ class SubmissionResponse(BaseModel):
     submitted_at: Optional[datetime]
     summary: str
     feedback: Optional[str] = None
-    score: float
+    score: Optional[float] = None
+    status: Optional[SubmissionStatus]
+
+
+class SubmissionBrief(BaseModel):
+    """A submission without its answers, summary and feedback, for listings"""
+    id: UUID
+    email: str
+    exam_id: str
+    exam_name: str
+    submitted_at: Optional[datetime]
+    score: Optional[float] = None
     status: Optional[SubmissionStatus]
 
 
@@ -48,6 +59,11 @@ class CodeExecution(BaseModel):
     code: str
     language: Language
     database: Optional[Literal["chinook", "northwind"]] = None
+    # SQL and large pandas results are returned a page at a time
+    page_size: int = Field(default=1000, ge=1, le=10000)
+    cursor: Optional[str] = None
+    # Owner of stored pandas results
+    user_id: Optional[str] = None
 
 
 class HelpRequest(BaseModel):
@@ -1,20 +1,166 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass, field
+
 from fastapi import WebSocket
+from loguru import logger
+
+from .csautograde.serializer import dumps
+
+
+@dataclass
+class Client:
+    websocket: WebSocket
+    queue: asyncio.Queue
+    # Set when the client subscribed to one user's messages (/ws?user=)
+    user: str = None
+    connected_at: float = field(default_factory=time.monotonic)
+    # Last time the client received a message or sent us one
+    last_seen: float = field(default_factory=time.monotonic)
+    task: asyncio.Task = None
 
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
+    """
+    Fans messages out to the /ws clients.
+
+    Every connection has a bounded send queue drained by its own task, so a
+    broadcast only encodes the message once and enqueues it: a slow or dead
+    client never delays the others. A client whose queue is full, or whose
+    send takes longer than `send_timeout`, is disconnected. A heartbeat ping
+    is queued every `heartbeat_interval` seconds; clients that have not
+    completed a send (or sent us anything) for `heartbeat_timeout` are reaped.
+
+    `broadcast` goes to every client; `send_to` only to the clients that
+    connected for one user.
+    """
+
+    def __init__(self, queue_size: int = 100, send_timeout: float = 10,
+                 heartbeat_interval: float = 20, heartbeat_timeout: float = 60):
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.clients: dict[WebSocket, Client] = {}
+        self._heartbeat: asyncio.Task = None
+        self._stats = {"connected": 0, "disconnected": 0, "broadcasts": 0, "sent": 0,
+                       "dropped_slow": 0, "send_errors": 0, "reaped": 0,
+                       "total_latency_ms": 0.0, "max_latency_ms": 0.0}
+
+    @property
+    def active_connections(self) -> list[WebSocket]:
+        return list(self.clients)
+
+    def start(self):
+        self._heartbeat = asyncio.create_task(self._beat())
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, user: str = None):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        client = Client(websocket, asyncio.Queue(maxsize=self.queue_size), user=user)
+        client.task = asyncio.create_task(self._sender(client))
+        self.clients[websocket] = client
+        self._stats["connected"] += 1
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        client = self.clients.pop(websocket, None)
+        if client is None:
+            return
+        self._stats["disconnected"] += 1
+        if client.task is not None and client.task is not asyncio.current_task():
+            client.task.cancel()
+
+    def touch(self, websocket: WebSocket):
+        """Record that the client is alive, e.g. because it sent us a message"""
+        client = self.clients.get(websocket)
+        if client is not None:
+            client.last_seen = time.monotonic()
+
+    async def _close(self, client: Client, code: int, reason: str):
+        self.disconnect(client.websocket)
+        try:
+            await client.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+    async def _sender(self, client: Client):
+        while True:
+            text, enqueued_at = await client.queue.get()
+            try:
+                await asyncio.wait_for(client.websocket.send_text(text), self.send_timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._stats["send_errors"] += 1
+                logger.info(f"Dropping websocket client after failed send: {type(e).__name__} {e}")
+                await self._close(client, 1011, "send failed")
+                return
+            now = time.monotonic()
+            client.last_seen = now
+            latency_ms = (now - enqueued_at) * 1000
+            self._stats["sent"] += 1
+            self._stats["total_latency_ms"] += latency_ms
+            self._stats["max_latency_ms"] = max(self._stats["max_latency_ms"], latency_ms)
+
+    def _enqueue(self, client: Client, text: str) -> bool:
+        try:
+            client.queue.put_nowait((text, time.monotonic()))
+            return True
+        except asyncio.QueueFull:
+            self._stats["dropped_slow"] += 1
+            logger.info("Disconnecting slow websocket client with a full send queue")
+            # Stop queueing for it right away; 1013 asks the client to try again later
+            self.disconnect(client.websocket)
+            asyncio.create_task(self._close(client, 1013, "client too slow"))
+            return False
+
+    async def broadcast(self, message: dict) -> int:
+        """Queue `message` for every client; returns how many clients it was queued for"""
+        text = dumps(message).decode()
+        self._stats["broadcasts"] += 1
+        return sum(self._enqueue(client, text) for client in list(self.clients.values()))
+
+    async def send_to(self, user: str, message: dict) -> int:
+        """Queue `message` for the clients of `user`; returns how many clients it was queued for"""
+        recipients = [client for client in list(self.clients.values()) if client.user == user]
+        if not recipients:
+            return 0
+        text = dumps(message).decode()
+        return sum(self._enqueue(client, text) for client in recipients)
+
+    async def _beat(self):
+        ping = dumps({"type": "ping"}).decode()
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            for client in list(self.clients.values()):
+                if now - client.last_seen > self.heartbeat_timeout:
+                    self._stats["reaped"] += 1
+                    logger.info("Reaping stale websocket client")
+                    await self._close(client, 1001, "heartbeat timeout")
+                else:
+                    self._enqueue(client, ping)
+
+    def stats(self) -> dict:
+        depths = [client.queue.qsize() for client in self.clients.values()]
+        stats = dict(self._stats)
+        stats["avg_latency_ms"] = stats["total_latency_ms"] / stats["sent"] if stats["sent"] else 0.0
+        stats["clients"] = len(depths)
+        stats["queued"] = sum(depths)
+        stats["max_queue_depth"] = max(depths, default=0)
+        return stats
 
-    async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            await connection.send_json(message)
+    async def shutdown(self):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        for client in list(self.clients.values()):
+            await self._close(client, 1001, "server shutdown")
 
 
-manager = ConnectionManager()
+manager = ConnectionManager(
+    queue_size=int(os.getenv("WS_QUEUE_SIZE", 100)),
+    send_timeout=float(os.getenv("WS_SEND_TIMEOUT", 10)),
+    heartbeat_interval=float(os.getenv("WS_HEARTBEAT_INTERVAL", 20)),
+    heartbeat_timeout=float(os.getenv("WS_HEARTBEAT_TIMEOUT", 60)),
+)
@@ -1,11 +1,19 @@
 import os
 import boto3
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
 
+@lru_cache(maxsize=1)
+def get_client():
+    """One S3 client for every upload and read in this script"""
+    return boto3.client('s3', endpoint_url=os.getenv("S3_ENDPOINT_URL") or None)
+
+
 def upload_directory_to_s3(directory: str, bucket: str, s3_prefix: str = ""):
     """
     Uploads all files from a local directory to an AWS S3 bucket.
@@ -15,15 +23,19 @@ def upload_directory_to_s3(directory: str, bucket: str, s3_prefix: str = ""):
     - bucket: Name of the S3 bucket
     - s3_prefix: Optional prefix (folder path) in the S3 bucket
     """
-    s3_client = boto3.client('s3')
-    for root, _, files in os.walk(directory):
-        for file in files:
-            local_path = os.path.join(root, file)
-            relative_path = os.path.relpath(local_path, directory)
-            s3_key = os.path.join(s3_prefix, relative_path).replace("\\", "/")
+    s3_client = get_client()
+
+    def upload(local_path):
+        relative_path = os.path.relpath(local_path, directory)
+        s3_key = os.path.join(s3_prefix, relative_path).replace("\\", "/")
+
+        print(f"Uploading {local_path} to s3://{bucket}/{s3_key}")
+        s3_client.upload_file(local_path, bucket, s3_key)
 
-            print(f"Uploading {local_path} to s3://{bucket}/{s3_key}")
-            s3_client.upload_file(local_path, bucket, s3_key)
+    paths = [os.path.join(root, file)
+             for root, _, files in os.walk(directory) for file in files]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(upload, paths))
 
 
 def read_s3_file(bucket: str, s3_key: str):
@@ -37,8 +49,7 @@ def read_s3_file(bucket: str, s3_key: str):
     Returns:
     - str - Contents of the file
     """
-    s3 = boto3.client('s3')
-    response = s3.get_object(Bucket=bucket, Key=s3_key)
+    response = get_client().get_object(Bucket=bucket, Key=s3_key)
     content = response['Body'].read().decode('utf-8')
     return content
 